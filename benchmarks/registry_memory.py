@@ -0,0 +1,125 @@
+"""
+Memory used by the in-process state for a registry of 100,000 Concepts, as measured by tracemalloc.
+
+Run from the repository root:
+
+    python benchmarks/registry_memory.py [number of Concepts]
+
+Strings are made afresh for every object, as they are when parsed from SPARQL results, so that the effect of interning
+repeated URIs and labels shows.
+"""
+import os
+import sys
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from vocprez.index import MappedIndex, write_index
+from vocprez.model.concept import Concept
+from vocprez.model.property import Property
+
+N = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+VOCABS = 50
+SKOS = "http://www.w3.org/2004/02/skos/core#"
+PREDICATES = [(SKOS + "broader", "Broader"), (SKOS + "notation", "Notation"), (SKOS + "altLabel", "Alternative Label")]
+
+
+def fresh(*parts):
+    return "".join(parts)
+
+
+def vocab_uri(i):
+    return fresh("http://example.com/vocab/", str(i % VOCABS))
+
+
+def concept_uri(i):
+    return fresh("http://example.com/vocab/", str(i % VOCABS), "/concept/", str(i))
+
+
+class DictProperty:
+    """Property as it was, with an instance dict and no interning"""
+    def __init__(self, uri, label, value, value_label=None):
+        self.uri = uri
+        self.label = label
+        self.value = value
+        self.value_label = value_label
+
+
+class DictConcept:
+    """Concept as it was, with an instance dict and no interning"""
+    def __init__(self, vocab_uri, uri, prefLabel, definition, related_instances, annotations=None,
+                 other_properties=None):
+        self.vocab_uri = vocab_uri
+        self.uri = uri
+        self.prefLabel = prefLabel
+        self.definition = definition
+        self.related_instances = related_instances
+        self.annotations = annotations
+        self.agents = None
+        self.other_properties = other_properties
+
+
+def concepts(concept_class, property_class):
+    return [
+        concept_class(
+            vocab_uri(i),
+            concept_uri(i),
+            fresh("Concept ", str(i)),
+            None,
+            {
+                fresh(p): [property_class(fresh(p), fresh(label), concept_uri(i // 2), fresh("Concept ", str(i // 2)))]
+                for p, label in PREDICATES
+            },
+        )
+        for i in range(N)
+    ]
+
+
+def concept_index(intern):
+    i_ = sys.intern if intern else (lambda s: s)
+    return tuple(
+        (i_(concept_uri(i)), fresh("Concept ", str(i)), i_(concept_uri(i // 2)) if i else None)
+        for i in range(N)
+    )
+
+
+def types():
+    return {concept_uri(i): (fresh(SKOS, "Concept"), vocab_uri(i)) for i in range(N)}
+
+
+def mapped_types(directory):
+    path = os.path.join(directory, "DATA.idx")
+    with open(path, "wb") as f:
+        write_index(f, {}, "benchmark", types())
+    return MappedIndex(path).types
+
+
+def measure(build):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = build()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del kept
+    return used
+
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        results = [
+            ("Concept objects, dict-backed", measure(lambda: concepts(DictConcept, DictProperty))),
+            ("Concept objects, slotted & interned", measure(lambda: concepts(Concept, Property))),
+            ("concept index, not interned", measure(lambda: concept_index(False))),
+            ("concept index, interned", measure(lambda: concept_index(True))),
+            ("type map, dict", measure(types)),
+            ("type map, memory-mapped", measure(lambda: mapped_types(directory))),
+        ]
+
+    print("{:,} Concepts in {} vocabs".format(N, VOCABS))
+    for name, used in results:
+        print("{:<40}{:>10.1f} MB".format(name, used / 1024 / 1024))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+CPU time and peak memory used in turning the results of a vocab's concept list query, of 100,000 Concepts, into the
+(uri, prefLabel, broader) tuples that list_concepts() returns, as measured by time.process_time() (best of 3) and
+tracemalloc.
+
+Run from the repository root:
+
+    python benchmarks/sparql_results.py [number of Concepts]
+
+The response bodies are made up front and fed to the parsers in 64KB chunks, as they arrive from an endpoint, so only
+the parsing is measured.
+"""
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from vocprez.sparql_results import iter_json_bindings, iter_tsv_rows
+
+N = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+VARIABLES = ("c", "pl", "broader")
+CHUNK = 64 * 1024
+
+
+def concept(i):
+    return "http://example.com/vocab/concept/{}".format(i)
+
+
+def json_body():
+    bindings = []
+    for i in range(N):
+        binding = {
+            "c": {"type": "uri", "value": concept(i)},
+            "pl": {"type": "literal", "value": "Concept {}".format(i), "xml:lang": "en"},
+        }
+        if i:
+            binding["broader"] = {"type": "uri", "value": concept(i // 2)}
+        bindings.append(binding)
+    return json.dumps({"head": {"vars": list(VARIABLES)}, "results": {"bindings": bindings}}).encode("utf-8")
+
+
+def tsv_body():
+    lines = ["?c\t?pl\t?broader"]
+    for i in range(N):
+        lines.append('<{}>\t"Concept {}"@en\t{}'.format(concept(i), i, "<{}>".format(concept(i // 2)) if i else ""))
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+def chunks(body):
+    return (body[i:i + CHUNK] for i in range(0, len(body), CHUNK))
+
+
+def whole_json(body):
+    """As sparql_query() did before results were streamed: the whole response is parsed, then made into tuples"""
+    bindings = json.loads(body)["results"]["bindings"]
+    return [
+        (b["c"]["value"], b["pl"]["value"], b["broader"]["value"] if b.get("broader") else None)
+        for b in bindings
+    ]
+
+
+def streamed_json(body):
+    return [
+        (b["c"]["value"], b["pl"]["value"], b["broader"]["value"] if b.get("broader") else None)
+        for b in iter_json_bindings(chunks(body))
+    ]
+
+
+def streamed_tsv(body):
+    return list(iter_tsv_rows(chunks(body), VARIABLES))
+
+
+def measure(parse, body):
+    # timed apart from tracing memory, which slows Python code down a lot more than C code such as json.loads()
+    seconds = []
+    for _ in range(3):
+        started = time.process_time()
+        rows = parse(body)
+        seconds.append(time.process_time() - started)
+        assert len(rows) == N
+        del rows
+
+    tracemalloc.start()
+    rows = parse(body)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return min(seconds), peak
+
+
+def main():
+    json_data = json_body()
+    tsv_data = tsv_body()
+    results = [
+        ("JSON, parsed whole", len(json_data), measure(whole_json, json_data)),
+        ("JSON, streamed bindings", len(json_data), measure(streamed_json, json_data)),
+        ("TSV, streamed tuples", len(tsv_data), measure(streamed_tsv, tsv_data)),
+    ]
+
+    print("{:,} Concepts".format(N))
+    print("{:<30}{:>12}{:>12}{:>14}".format("", "body (MB)", "CPU (s)", "peak (MB)"))
+    for name, size, (seconds, peak) in results:
+        print("{:<30}{:>12.1f}{:>12.2f}{:>14.1f}".format(name, size / 1024 / 1024, seconds, peak / 1024 / 1024))
+
+
+if __name__ == "__main__":
+    main()
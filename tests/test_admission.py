@@ -0,0 +1,34 @@
+import os
+from vocprez.admission import SlotLimiter
+
+
+def test_slot_limiter(tmp_path):
+    limiter = SlotLimiter(str(tmp_path), slots=2)
+    release_a = limiter.acquire()
+    release_b = limiter.acquire()
+    assert release_a is not None and release_b is not None
+    assert limiter.acquire(wait=0.1) is None
+
+    # names have their own slots
+    release_c = limiter.acquire("client")
+    assert release_c is not None
+
+    release_a()
+    release_a()  # releasing twice is harmless
+    release_d = limiter.acquire()
+    assert release_d is not None
+
+    for release in (release_b, release_c, release_d):
+        release()
+
+    # named slots' files are removed once they are given back, shared ones are kept
+    assert sorted(os.listdir(tmp_path)) == ["shared.0.lock", "shared.1.lock"]
+    release_e = limiter.acquire("client")
+    assert limiter.acquire("client") is not None
+    release_e()
+    assert limiter.acquire("client") is not None
+
+
+def test_slot_limiter_unlimited(tmp_path):
+    limiter = SlotLimiter(str(tmp_path))
+    assert all(limiter.acquire() is not None for _ in range(10))
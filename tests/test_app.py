@@ -0,0 +1,127 @@
+import datetime
+import time
+import pytest
+from flask import g
+import vocprez.app as vocprez_app
+from vocprez import utils
+from vocprez.model.concept import Concept
+from vocprez.model.vocabulary import Vocabulary
+from vocprez.registry import REGISTRY
+
+
+def vocab(id, title):
+    return Vocabulary(
+        id,
+        "http://ex.com/{}".format(id),
+        title,
+        "The {} vocab".format(title),
+        None,
+        datetime.datetime(2020, 1, 1),
+        datetime.datetime(2020, 6, 1),
+        None,
+        "SPARQL",
+        sparql_endpoint="http://127.0.0.1:9/sparql",
+    )
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(vocprez_app.config, "DEBUG", False)
+    monkeypatch.setattr(utils, "cache_load", lambda: setattr(g, "VOCABS", REGISTRY.vocabs))
+    REGISTRY.swap({v.uri: v for v in (vocab("alpha", "Alpha"), vocab("beta", "Beta"))})
+    utils.RESPONSE_CACHE.clear()
+    vocprez_app.app.testing = True
+    try:
+        with vocprez_app.app.test_client() as client:
+            yield client
+    finally:
+        utils.RESPONSE_CACHE.clear()
+        REGISTRY.clear()
+
+
+def test_cached_responses_differ_by_argument(client):
+    everything = client.get("/vocab/?_mediatype=text/turtle")
+    filtered = client.get("/vocab/?_mediatype=text/turtle&filter=beta")
+    assert b"http://ex.com/alpha" in everything.data
+    assert b"http://ex.com/alpha" not in filtered.data
+    assert b"http://ex.com/beta" in filtered.data
+    assert everything.headers["ETag"] != filtered.headers["ETag"]
+
+    # arguments given in another order are the same request
+    assert client.get("/vocab/?filter=beta&_mediatype=text/turtle").data == filtered.data
+    assert client.get("/vocab/?_mediatype=text/turtle").data == everything.data
+
+
+def test_partial_responses_are_not_cached(client, monkeypatch):
+    def unavailable(self, vocab_uri):
+        raise ValueError("unavailable")
+
+    monkeypatch.setattr(vocprez_app.source.SPARQL, "get_concept_hierarchy", unavailable)
+    monkeypatch.setattr(vocprez_app.source.SPARQL, "list_concepts", lambda self, vocab_uri: [])
+    monkeypatch.setattr(vocprez_app.source.SPARQL, "list_collections", lambda self, vocab_uri: [])
+    REGISTRY.types = {"http://ex.com/alpha": ("http://www.w3.org/2004/02/skos/core#ConceptScheme", None)}
+
+    response = client.get("/object?uri=http://ex.com/alpha")
+    assert response.status_code == 200
+    assert "ETag" not in response.headers
+    assert "Last-Modified" not in response.headers
+    assert len(utils.RESPONSE_CACHE) == 0
+
+
+def test_conditional_get(client):
+    everything = client.get("/vocab/")
+    assert client.get("/vocab/", headers={"If-None-Match": everything.headers["ETag"]}).status_code == 304
+    # another filter is another response, whose ETag doesn't match
+    assert client.get("/vocab/?filter=beta", headers={"If-None-Match": everything.headers["ETag"]}).status_code == 200
+
+    # a vocab added with an older modified date than the others still changes the list's Last-Modified
+    vocabs = dict(REGISTRY.vocabs)
+    vocabs["http://ex.com/gamma"] = vocab("gamma", "Gamma")
+    REGISTRY.swap(vocabs, source_mtime=time.time() + 60)
+    assert client.get("/vocab/", headers={"If-Modified-Since": everything.headers["Last-Modified"]}).status_code == 200
+
+
+def test_concepts_batch(client, monkeypatch):
+    skos = "http://www.w3.org/2004/02/skos/core#"
+    queries = []
+
+    def sparql_query(q):
+        queries.append(q)
+        return [
+            {"o": {"value": "http://ex.com/beta/c2"}, "c": {"value": skos + "Concept"},
+             "cs": {"value": "http://ex.com/beta"}},
+        ]
+
+    def get_concepts(self, vocab_uri, uris):
+        return {uri: Concept(vocab_uri, uri, uri[-2:], None, {}) for uri in uris}
+
+    monkeypatch.setattr(utils, "sparql_query", sparql_query)
+    monkeypatch.setattr(vocprez_app.source.SPARQL, "get_concepts", get_concepts)
+    REGISTRY.types = {"http://ex.com/alpha/c1": (skos + "Concept", "http://ex.com/alpha")}
+
+    response = client.get("/concepts?uri=http://ex.com/alpha/c1&uri=http://ex.com/beta/c2&uri=http://ex.com/x")
+    assert [c["uri"] for c in response.json["concepts"]] == ["http://ex.com/alpha/c1", "http://ex.com/beta/c2"]
+    assert response.json["concepts"][1]["vocab_uri"] == "http://ex.com/beta"
+    assert response.json["not_found"] == ["http://ex.com/x"]
+    # the Concepts the type map doesn't know are looked up together
+    assert len(queries) == 1
+    assert "<http://ex.com/beta/c2> <http://ex.com/x>" in queries[0]
+
+
+def test_concepts_batch_invalid_uris(client, monkeypatch):
+    queries = []
+    monkeypatch.setattr(utils, "sparql_query", lambda q: queries.append(q) or [])
+    monkeypatch.setattr(vocprez_app.source.SPARQL, "get_concepts", lambda self, vocab_uri, uris: {})
+
+    response = client.post("/concepts", data={"uri": [
+        "http://ex.com/x",
+        "http://ex.com/y> } DROP ALL { <",
+        "http://ex.com/a b",
+        'http://ex.com/"q"',
+        "http://ex.com/z",
+    ]})
+    assert response.json["invalid"] == ["http://ex.com/y> } DROP ALL { <", "http://ex.com/a b", 'http://ex.com/"q"']
+    assert response.json["not_found"] == ["http://ex.com/x", "http://ex.com/z"]
+    # only the valid URIs are queried for, together
+    assert len(queries) == 1
+    assert "VALUES ?o { <http://ex.com/x> <http://ex.com/z> }" in queries[0]
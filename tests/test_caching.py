@@ -0,0 +1,86 @@
+import os
+import time
+from vocprez.caching import DiskCache, LRUCache
+
+
+def test_disk_cache_get_put(tmp_path):
+    cache = DiskCache(str(tmp_path / "graphs"))
+    assert cache.get("http://example.com/vocab|1") is None
+
+    cache.put("http://example.com/vocab|1", {"a": 1})
+    assert cache.get("http://example.com/vocab|1") == {"a": 1}
+    assert cache.get("http://example.com/vocab|2") is None
+
+    cache.clear()
+    assert cache.get("http://example.com/vocab|1") is None
+
+
+def test_disk_cache_evicts_least_recently_used(tmp_path):
+    cache = DiskCache(str(tmp_path), max_items=2)
+    cache.put("a", "a")
+    cache.put("b", "b")
+    # make "a" the oldest entry, then use it so that "b" becomes the least recently used
+    past = time.time() - 100
+    os.utime(cache._path("a"), (past, past))
+    os.utime(cache._path("b"), (past + 1, past + 1))
+    cache.get("a")
+
+    cache.put("c", "c")
+    assert cache.get("a") == "a"
+    assert cache.get("b") is None
+    assert cache.get("c") == "c"
+
+
+def test_disk_cache_max_bytes(tmp_path):
+    cache = DiskCache(str(tmp_path), max_bytes=3000)
+    cache.put("a", "x" * 2000)
+    past = time.time() - 100
+    os.utime(cache._path("a"), (past, past))
+    cache.put("b", "y" * 2000)
+    assert len(os.listdir(str(tmp_path))) == 1
+    assert cache.get("b") == "y" * 2000
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(max_items=2)
+    cache.put("a", "a")
+    cache.put("b", "b")
+    cache.get("a")
+
+    cache.put("c", "c")
+    assert cache.get("a") == "a"
+    assert cache.get("b") is None
+    assert cache.get("c") == "c"
+
+
+def test_lru_cache_max_bytes():
+    cache = LRUCache(max_bytes=10)
+    cache.put("a", b"x" * 6)
+    cache.put("b", b"y" * 6)
+    assert cache.get("a") is None
+    assert cache.get("b") == b"y" * 6
+    assert cache.bytes == 6
+
+    # too big to ever fit
+    cache.put("c", b"z" * 11)
+    assert cache.get("c") is None
+    assert cache.get("b") == b"y" * 6
+
+
+def test_lru_cache_ttl():
+    cache = LRUCache(ttl=-1)
+    cache.put("a", "a")
+    assert cache.get("a") is None
+    assert len(cache) == 0
+
+
+def test_lru_cache_spills_to_disk(tmp_path):
+    cache = LRUCache(max_items=1, spill=DiskCache(str(tmp_path)))
+    cache.put("a", "a")
+    cache.put("b", "b")
+    assert len(cache) == 1
+    assert cache.get("a") == "a"
+
+    cache.clear()
+    assert cache.get("a") is None
+    assert cache.stats()["misses"] == 1
@@ -0,0 +1,85 @@
+import datetime
+import pytest
+from vocprez.index import IndexFormatError, MappedIndex, write_index
+from vocprez.model.vocabulary import Vocabulary
+
+CONCEPT = "http://www.w3.org/2004/02/skos/core#Concept"
+
+
+def test_index_round_trip(tmp_path):
+    vocabs = {
+        "http://ex.com/a": Vocabulary(
+            "a",
+            "http://ex.com/a",
+            "Vocab Ä",
+            "<p>About A</p>",
+            None,
+            datetime.datetime(2020, 1, 2, 3, 4, 5),
+            datetime.datetime(2021, 1, 2, tzinfo=datetime.timezone.utc),
+            "1.0",
+            "SPARQL",
+            sparql_endpoint="http://ex.com/sparql",
+        ),
+    }
+    types = {"http://ex.com/a/{}".format(i): (CONCEPT, "http://ex.com/a") for i in range(1000)}
+    types["http://ex.com/a"] = ("http://www.w3.org/2004/02/skos/core#ConceptScheme", None)
+
+    path = str(tmp_path / "DATA.idx")
+    with open(path, "wb") as f:
+        write_index(f, vocabs, "0123456789abcdef0123456789abcdef", types)
+
+    index = MappedIndex(path)
+    assert index.generation == "0123456789abcdef0123456789abcdef"
+
+    vocab = index.vocabs()["http://ex.com/a"]
+    for field in ("id", "uri", "title", "description", "creator", "created", "modified", "versionInfo", "source",
+                  "sparql_endpoint", "sparql_username"):
+        assert getattr(vocab, field) == getattr(vocabs["http://ex.com/a"], field)
+
+    assert len(index.types) == 1001
+    for uri, t in types.items():
+        assert index.types.get(uri) == t
+    assert index.types.get("http://ex.com/a/1000") is None
+    assert "http://ex.com/b" not in index.types
+    assert dict(index.types.items()) == types
+
+
+def test_mapped_vocabs(tmp_path):
+    vocabs = {
+        "http://ex.com/{}".format(i): Vocabulary(str(i), "http://ex.com/{}".format(i), "Vocab {}".format(i), None, None,
+                                                 None, None, None, "SPARQL")
+        for i in (3, 1, 2)
+    }
+    path = str(tmp_path / "DATA.idx")
+    with open(path, "wb") as f:
+        write_index(f, vocabs, "g")
+
+    mapped = MappedIndex(path).vocabs()
+    assert list(mapped) == list(vocabs)
+    assert "http://ex.com/1" in mapped and "http://ex.com/4" not in mapped
+    # Vocabulary objects are only made when asked for, and then kept
+    assert mapped._vocabs == {}
+    assert mapped["http://ex.com/1"].title == "Vocab 1"
+    assert list(mapped._vocabs) == ["http://ex.com/1"]
+    assert mapped["http://ex.com/1"] is mapped["http://ex.com/1"]
+    with pytest.raises(KeyError):
+        mapped["http://ex.com/4"]
+
+
+def test_index_without_types(tmp_path):
+    path = str(tmp_path / "DATA.idx")
+    with open(path, "wb") as f:
+        write_index(f, {}, "g")
+    index = MappedIndex(path)
+    assert index.vocabs() == {}
+    assert index.types is None
+
+
+def test_not_an_index(tmp_path):
+    path = tmp_path / "DATA.p"
+    path.write_bytes(b"\x80\x04" + b"\x00" * 200)
+    with pytest.raises(IndexFormatError):
+        MappedIndex(str(path))
+    path.write_bytes(b"")
+    with pytest.raises(IndexFormatError):
+        MappedIndex(str(path))
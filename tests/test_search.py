@@ -0,0 +1,52 @@
+from vocprez.search import SearchIndex
+
+
+def make_index():
+    index = SearchIndex()
+    index.add("http://ex.com/v1", "http://ex.com/v1/granite", SearchIndex.PREF_LABEL, "Granite")
+    index.add("http://ex.com/v1", "http://ex.com/v1/granite", SearchIndex.DEFINITION, "An igneous rock")
+    index.add("http://ex.com/v1", "http://ex.com/v1/granodiorite", SearchIndex.PREF_LABEL, "Granodiorite")
+    index.add("http://ex.com/v1", "http://ex.com/v1/basalt", SearchIndex.PREF_LABEL, "Basalt")
+    index.add("http://ex.com/v1", "http://ex.com/v1/basalt", SearchIndex.ALT_LABEL, "Granite-like")
+    index.add("http://ex.com/v2", "http://ex.com/v2/granite", SearchIndex.PREF_LABEL, "granite")
+    index.add("http://ex.com/v2", "http://ex.com/v2/rock", SearchIndex.PREF_LABEL, "Rock")
+    index.add("http://ex.com/v2", "http://ex.com/v2/rock", SearchIndex.HIDDEN_LABEL, "GRANITE")
+    # a field added out of Concept order
+    index.add("http://ex.com/v1", "http://ex.com/v1/granodiorite", SearchIndex.DEFINITION, "Like granite")
+    index.finalise()
+    return index
+
+
+def test_search_weights():
+    results = make_index().search("granite")
+    assert results == {
+        "http://ex.com/v1": [
+            ("http://ex.com/v1/granite", "Granite"),  # 50 + 10
+            ("http://ex.com/v1/basalt", "Basalt"),  # 5
+            ("http://ex.com/v1/granodiorite", "Granodiorite"),  # 1
+        ],
+        "http://ex.com/v2": [
+            ("http://ex.com/v2/granite", "granite"),  # 50 + 10
+            ("http://ex.com/v2/rock", "Rock"),  # 5
+        ],
+    }
+
+
+def test_search_graph():
+    results = make_index().search("GRANO", graph="http://ex.com/v1")
+    assert results == {"http://ex.com/v1": [("http://ex.com/v1/granodiorite", "Granodiorite")]}
+    assert make_index().search("granodiorite", graph="http://ex.com/v2") == {}
+
+
+def test_search_without_graphs():
+    index = make_index().without_graphs({"http://ex.com/v1"})
+    assert index.search("granite") == make_index().search("granite", graph="http://ex.com/v2")
+    assert index.search("granodiorite") == {}
+
+
+def test_search_short_and_unmatched_terms():
+    index = make_index()
+    assert set(index.search("ro").keys()) == {"http://ex.com/v1", "http://ex.com/v2"}
+    assert index.search("obsidian") == {}
+    # search terms are plain text, not regular expressions
+    assert index.search("gran.te") == {}
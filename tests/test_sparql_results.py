@@ -0,0 +1,106 @@
+import json
+from vocprez.sparql_results import (
+    iter_bindings,
+    iter_csv_bindings,
+    iter_json_bindings,
+    iter_rows,
+    iter_tsv_bindings,
+    iter_tsv_rows,
+    iter_xml_bindings,
+)
+
+RESULTS = [
+    {
+        "c": {"type": "uri", "value": "http://ex.com/c1"},
+        "pl": {"type": "literal", "value": "Ünïcode \"quoted\"\tand\ttabbed", "xml:lang": "en"},
+    },
+    {
+        "c": {"type": "uri", "value": "http://ex.com/c2"},
+        "n": {"type": "literal", "value": "2", "datatype": "http://www.w3.org/2001/XMLSchema#integer"},
+    },
+]
+
+
+def chunked(data, size):
+    return (data[i:i + size] for i in range(0, len(data), size))
+
+
+def test_json():
+    data = json.dumps({"head": {"vars": ["c", "pl", "n"]}, "results": {"bindings": RESULTS}}).encode("utf-8")
+    # results split over chunks anywhere, even part way through a character, are put back together
+    for size in (1, 7, len(data)):
+        assert list(iter_json_bindings(chunked(data, size))) == RESULTS
+    assert list(iter_json_bindings([b'{"head": {}, "results": {"bindings": []}}'])) == []
+    assert list(iter_json_bindings([b'{"head": {}, "boolean": true}'])) == []
+
+
+def test_json_is_lazy():
+    def chunks():
+        yield b'{"head": {"vars": ["c"]}, "results": {"bindings": [{"c": {"type": "uri", "value": "http://ex.com/c1"}}'
+        raise AssertionError("read past the first result")
+
+    assert next(iter_json_bindings(chunks())) == {"c": {"type": "uri", "value": "http://ex.com/c1"}}
+
+
+def test_xml():
+    data = """<?xml version="1.0"?>
+        <sparql xmlns="http://www.w3.org/2005/sparql-results#">
+          <head><variable name="c"/><variable name="pl"/><variable name="n"/></head>
+          <results>
+            <result>
+              <binding name="c"><uri>http://ex.com/c1</uri></binding>
+              <binding name="pl"><literal xml:lang="en">Ünïcode "quoted"\tand\ttabbed</literal></binding>
+            </result>
+            <result>
+              <binding name="c"><uri>http://ex.com/c2</uri></binding>
+              <binding name="n"><literal datatype="http://www.w3.org/2001/XMLSchema#integer">2</literal></binding>
+            </result>
+          </results>
+        </sparql>""".encode("utf-8")
+    for size in (1, 64, len(data)):
+        assert list(iter_xml_bindings(chunked(data, size))) == RESULTS
+
+
+def test_tsv():
+    data = "?c\t?pl\t?n\n" \
+           "<http://ex.com/c1>\t\"\\u00DCn\\u00efcode \\\"quoted\\\"\\tand\\ttabbed\"@en\t\n" \
+           "<http://ex.com/c2>\t\t2\n".encode("utf-8")
+    for size in (1, 5, len(data)):
+        assert list(iter_tsv_bindings(chunked(data, size))) == RESULTS
+    assert list(iter_tsv_bindings([b"?b\n_:b0\n"])) == [{"b": {"type": "bnode", "value": "b0"}}]
+
+
+def test_tsv_rows():
+    data = "?c\t?pl\t?n\n" \
+           "<http://ex.com/c1>\t\"a \\\"quoted\\\"\\tlabel\"@en\t\n" \
+           "_:b0\t\"b\"^^<http://www.w3.org/2001/XMLSchema#string>\t2\n".encode("utf-8")
+    assert list(iter_tsv_rows(chunked(data, 4), ("c", "pl", "n"))) == [
+        ("http://ex.com/c1", 'a "quoted"\tlabel', None),
+        ("b0", "b", "2"),
+    ]
+    # variables are picked out by name, in the order asked for
+    assert list(iter_tsv_rows([data], ("n", "c", "x"))) == [(None, "http://ex.com/c1", None), ("2", "b0", None)]
+
+
+def test_rows_from_bindings():
+    data = json.dumps({"head": {"vars": ["c", "pl", "n"]}, "results": {"bindings": RESULTS}}).encode("utf-8")
+    assert list(iter_rows([data], "application/sparql-results+json", ("c", "n"))) == [
+        ("http://ex.com/c1", None),
+        ("http://ex.com/c2", "2"),
+    ]
+    assert list(iter_rows([b"?c\n<http://ex.com/c1>\n"], "text/tab-separated-values", ("c",))) == \
+        [("http://ex.com/c1",)]
+
+
+def test_csv():
+    data = 'c,pl\r\nhttp://ex.com/c1,"a, ""quoted""\nlabel"\r\nhttp://ex.com/c2,\r\n'.encode("utf-8")
+    assert list(iter_csv_bindings(chunked(data, 3))) == [
+        {"c": {"type": "literal", "value": "http://ex.com/c1"}, "pl": {"type": "literal", "value": 'a, "quoted"\nlabel'}},
+        {"c": {"type": "literal", "value": "http://ex.com/c2"}},
+    ]
+
+
+def test_iter_bindings():
+    assert list(iter_bindings([b"?c\n<http://ex.com/c1>\n"], "text/tab-separated-values; charset=utf-8")) == \
+        [{"c": {"type": "uri", "value": "http://ex.com/c1"}}]
+    assert list(iter_bindings([b'{"results": {"bindings": [{}]}}'], "application/sparql-results+json")) == [{}]
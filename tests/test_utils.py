@@ -1,4 +1,15 @@
+import datetime
+import gzip
+import pickle
+import threading
+import time
+from types import SimpleNamespace
+import zlib
+import pytest
 from vocprez import utils
+from vocprez.caching import DiskCache
+from vocprez.registry import REGISTRY
+from vocprez.search import SearchIndex
 
 
 def test_get_absolute_uri():
@@ -65,3 +76,426 @@ def test_get_system_uri():
     uri = "http://resource.geosciml.org/def/voc/?_profile=x&_mediatype=y"
     assert utils.get_system_uri(uri, {"_profile": "alt"}) == \
            "http://localhost:5000/object?uri=http%3A//resource.geosciml.org/def/voc/&_mediatype=y&_profile=alt"
+
+
+def test_build_concept_hierarchy():
+    rows = [
+        ("http://ex.com/b", "B", "http://ex.com/t"),
+        ("http://ex.com/t", "T", None),
+        ("http://ex.com/a", "A", "http://ex.com/t"),
+        ("http://ex.com/aa", "AA", "http://ex.com/a"),
+        ("http://ex.com/s", "S", None),
+    ]
+    assert utils.build_concept_hierarchy(rows) == [
+        (1, "http://ex.com/s", "S", None),
+        (1, "http://ex.com/t", "T", None),
+        (2, "http://ex.com/a", "A", "http://ex.com/t"),
+        (3, "http://ex.com/aa", "AA", "http://ex.com/a"),
+        (2, "http://ex.com/b", "B", "http://ex.com/t"),
+    ]
+
+
+def test_build_concept_hierarchy_polyhierarchy_and_cycles():
+    rows = [
+        ("http://ex.com/t1", "T1", None),
+        ("http://ex.com/t2", "T2", None),
+        # c has two broader concepts so it, and its narrower concept, appear under both
+        ("http://ex.com/c", "C", "http://ex.com/t1"),
+        ("http://ex.com/c", "C", "http://ex.com/t2"),
+        ("http://ex.com/n", "N", "http://ex.com/c"),
+        # n is also broader than c: a cycle
+        ("http://ex.com/c", "C", "http://ex.com/n"),
+    ]
+    assert utils.build_concept_hierarchy(rows) == [
+        (1, "http://ex.com/t1", "T1", None),
+        (2, "http://ex.com/c", "C", "http://ex.com/t1"),
+        (3, "http://ex.com/n", "N", "http://ex.com/c"),
+        (1, "http://ex.com/t2", "T2", None),
+        (2, "http://ex.com/c", "C", "http://ex.com/t2"),
+        (3, "http://ex.com/n", "N", "http://ex.com/c"),
+    ]
+
+
+def test_build_concept_hierarchy_deep():
+    depth = 50000
+    rows = [
+        ("c{}".format(i), "c{}".format(i), "c{}".format(i - 1) if i > 0 else None)
+        for i in range(depth)
+    ]
+    hierarchy = utils.build_concept_hierarchy(rows)
+    assert len(hierarchy) == depth
+    assert hierarchy[-1] == (depth, "c{}".format(depth - 1), "c{}".format(depth - 1), "c{}".format(depth - 2))
+
+
+def test_draw_concept_hierarchy():
+    hierarchy = [
+        (1, "http://ex.com/s", "S", None),
+        (1, "http://ex.com/t", "T", None),
+        (2, "http://ex.com/a", "A & B", "http://ex.com/t"),
+    ]
+    assert utils.draw_concept_hierarchy(hierarchy) == (
+        '<ul>\n'
+        '<li><a href="http://localhost:5000/object?uri=http%3A//ex.com/s">S</a></li>\n'
+        '<li><span class="caret"><a href="http://localhost:5000/object?uri=http%3A//ex.com/t">T</a></span>'
+        '<ul class="nested">\n'
+        '<li><a href="http://localhost:5000/object?uri=http%3A//ex.com/a">A &amp; B</a></li>\n'
+        '</ul>\n'
+        '</li>\n'
+        '</ul>\n'
+    )
+    assert utils.draw_concept_hierarchy([]) == ""
+
+
+def test_is_iri():
+    assert utils.is_iri("http://ex.com/a#b?c=d&e=%20")
+    assert utils.is_iri("urn:ex:\u00fc")
+    for uri in ("", "http://ex.com/a b", "http://ex.com/a>", "<http://ex.com/a", 'http://ex.com/"', "http://ex.com/{a}",
+                "http://ex.com/a|b", "http://ex.com/a^b", "http://ex.com/`", "http://ex.com/a\\b", "http://ex.com/\n"):
+        assert not utils.is_iri(uri)
+
+
+def test_get_last_modified():
+    vocabs = {
+        "http://ex.com/a": SimpleNamespace(id="a", modified=datetime.datetime(2020, 1, 2, 3, 4, 5)),
+        "http://ex.com/b": SimpleNamespace(id="b", modified=datetime.date(2021, 6, 1)),
+        "http://ex.com/c": SimpleNamespace(id="c", modified=None),
+    }
+    REGISTRY.swap(
+        vocabs,
+        source_mtime=datetime.datetime(2022, 1, 1, tzinfo=datetime.timezone.utc).timestamp(),
+        types={"http://ex.com/a/x": ("http://www.w3.org/2004/02/skos/core#Concept", "http://ex.com/a")},
+    )
+    try:
+        utc = datetime.timezone.utc
+        # the lists of vocabs change when one is added or removed, so they are as old as the vocab index
+        assert utils.get_last_modified() == datetime.datetime(2022, 1, 1, tzinfo=utc)
+        assert utils.get_last_modified(uri="http://ex.com/a") == datetime.datetime(2020, 1, 2, 3, 4, 5, tzinfo=utc)
+        assert utils.get_last_modified(uri="http://ex.com/a/x") == datetime.datetime(2020, 1, 2, 3, 4, 5, tzinfo=utc)
+        assert utils.get_last_modified(vocab_id="b") == datetime.datetime(2021, 6, 1, tzinfo=utc)
+        assert utils.get_last_modified(uri="http://ex.com/c") is None
+        assert utils.get_last_modified(uri="http://ex.com/unknown") is None
+    finally:
+        REGISTRY.clear()
+
+
+def test_refresh_in_background_after_failure(monkeypatch):
+    attempts = []
+
+    def failing_rebuild():
+        attempts.append(time.time())
+        raise ValueError("unavailable")
+
+    def refresh():
+        utils._refresh_in_background()
+        while REGISTRY.refreshing:
+            time.sleep(0.01)
+
+    monkeypatch.setattr(utils, "_rebuild", failing_rebuild)
+    monkeypatch.setattr(utils.config, "CACHE_REFRESH_RETRY_SECONDS", 60, raising=False)
+    try:
+        refresh()
+        refresh()
+        # no refresh is tried again until the retry period after a failure is over
+        assert len(attempts) == 1
+        REGISTRY.refresh_failed_at -= 61
+        refresh()
+        assert len(attempts) == 2
+    finally:
+        REGISTRY.clear()
+
+
+def test_cache_reload_during_refresh(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils.config, "CACHE_FILE", str(tmp_path / "DATA.idx"))
+    monkeypatch.setattr(utils, "SEARCH_INDEX_FILE", str(tmp_path / "DATA.search.p"))
+    monkeypatch.setattr(utils, "GRAPH_CACHE", DiskCache(str(tmp_path / "graphs")))
+    monkeypatch.setattr(utils, "_collect_all", lambda: (None, None))
+    refreshing = threading.Event()
+    finish_refresh = threading.Event()
+
+    def collect_vocabs():
+        if not refreshing.is_set():
+            refreshing.set()
+            finish_refresh.wait(5)
+        return {}
+
+    monkeypatch.setattr(utils, "collect_vocabs", collect_vocabs)
+    reload = threading.Thread(target=utils.cache_reload, kwargs={"full": True}, daemon=True)
+    try:
+        refresh = threading.Thread(target=utils._rebuild, kwargs={"force": True}, daemon=True)
+        refresh.start()
+        assert refreshing.wait(5)
+        # a full reload waits for the refresh to finish, rather than for the registry lock the refresh needs
+        reload.start()
+        time.sleep(0.1)
+        finish_refresh.set()
+        refresh.join(5)
+        reload.join(5)
+        assert not refresh.is_alive() and not reload.is_alive()
+        assert REGISTRY.is_loaded()
+    finally:
+        finish_refresh.set()
+        if not reload.is_alive():  # else it holds the registry lock for good
+            REGISTRY.clear()
+
+
+def test_get_search_index(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, "SEARCH_INDEX_FILE", str(tmp_path / "DATA.search.p"))
+    monkeypatch.setattr(utils, "collect_search_index", lambda: pytest.fail("built in a request"))
+    loads = []
+    load_search_index_file = utils._load_search_index_file
+    monkeypatch.setattr(utils, "_load_search_index_file", lambda g: loads.append(g) or load_search_index_file(g))
+    try:
+        REGISTRY.swap({}, generation="a")
+        assert utils.get_search_index() is None  # no file
+
+        with open(utils.SEARCH_INDEX_FILE, "wb") as f:
+            pickle.dump({"generation": "b", "search_index": SearchIndex()}, f)
+        assert utils.get_search_index() is None
+        # a file of another vocab index's search index isn't read again until it changes
+        assert utils.get_search_index() is None
+        assert loads == ["a"]
+
+        REGISTRY.swap({}, generation="b")
+        assert isinstance(utils.get_search_index(), SearchIndex)
+        assert utils.get_search_index() is REGISTRY.search_index
+        assert loads == ["a", "b"]
+    finally:
+        REGISTRY.clear()
+
+
+def test_changed_vocabs():
+    vocabs = {
+        "http://ex.com/a": SimpleNamespace(modified=datetime.datetime(2020, 1, 1), sparql_endpoint="http://ex.com/s"),
+        "http://ex.com/b": SimpleNamespace(modified=datetime.datetime(2020, 1, 1), sparql_endpoint="http://ex.com/s"),
+        "http://ex.com/c": SimpleNamespace(modified=None, sparql_endpoint="http://ex.com/s"),
+    }
+    REGISTRY.swap(vocabs)
+    REGISTRY.concept_index("http://ex.com/a", "en", lambda: [("http://ex.com/a/x", "x", None)])
+    REGISTRY.concept_index("http://ex.com/b", "en", lambda: [("http://ex.com/b/x", "x", None)])
+    try:
+        new_vocabs = {
+            "http://ex.com/a": SimpleNamespace(modified=datetime.datetime(2020, 1, 1), sparql_endpoint="http://ex.com/s"),
+            "http://ex.com/b": SimpleNamespace(modified=datetime.datetime(2021, 1, 1), sparql_endpoint="http://ex.com/s"),
+            "http://ex.com/c": SimpleNamespace(modified=None, sparql_endpoint="http://ex.com/s"),
+            "http://ex.com/d": SimpleNamespace(modified=datetime.datetime(2020, 1, 1), sparql_endpoint="http://ex.com/s"),
+        }
+        assert REGISTRY.changed_vocabs(new_vocabs) == {"http://ex.com/b", "http://ex.com/c", "http://ex.com/d"}
+
+        # the concept indexes of unchanged vocabs are kept when the vocab index is swapped
+        REGISTRY.swap(new_vocabs)
+        assert REGISTRY.concept_index("http://ex.com/a", "en", lambda: []) == (("http://ex.com/a/x", "x", None),)
+        assert REGISTRY.concept_index("http://ex.com/b", "en", lambda: []) == ()
+    finally:
+        REGISTRY.clear()
+
+
+def test_vocab_part():
+    REGISTRY.swap({"http://ex.com/a": SimpleNamespace(modified=None)}, generation="g1")
+    built = []
+
+    def build():
+        built.append(1)
+        return "hierarchy"
+
+    try:
+        assert REGISTRY.vocab_part("http://ex.com/a", "concept_hierarchy", "en", build) == "hierarchy"
+        assert REGISTRY.vocab_part("http://ex.com/a", "concept_hierarchy", "en", build) == "hierarchy"
+        assert len(built) == 1
+        # with no modified date, a vocab's parts are rebuilt for each build of the vocab index
+        REGISTRY.swap({"http://ex.com/a": SimpleNamespace(modified=None)}, generation="g2")
+        REGISTRY.vocab_part("http://ex.com/a", "concept_hierarchy", "en", build)
+        assert len(built) == 2
+    finally:
+        REGISTRY.clear()
+
+
+class FakeSource:
+    @staticmethod
+    def collect(details):
+        time.sleep(details.get("sleep", 0))
+        if details.get("fail"):
+            raise ValueError("unavailable")
+        return {details["vocab"]: SimpleNamespace(sparql_endpoint=details["sparql_endpoint"])}
+
+    @staticmethod
+    def collect_types(details, types, vocab_uris=None):
+        if details.get("fail"):
+            raise ValueError("unavailable")
+        types[details["vocab"] + "/c"] = ("http://www.w3.org/2004/02/skos/core#Concept", details["vocab"])
+
+    @staticmethod
+    def collect_search_index(details, search_index, vocab_uris=None):
+        if details.get("fail"):
+            raise ValueError("unavailable")
+        search_index.add(details["vocab"], details["vocab"] + "/c", SearchIndex.PREF_LABEL, "Concept")
+
+
+def test_collect_vocabs(monkeypatch):
+    monkeypatch.setattr(utils.source, "FAKE", FakeSource, raising=False)
+    monkeypatch.setattr(utils.config, "DATA_SOURCES", {
+        "a": {"source": "FAKE", "sparql_endpoint": "http://ex.com/a/sparql", "vocab": "http://ex.com/a", "sleep": 0.2},
+        "b": {"source": "FAKE", "sparql_endpoint": "http://ex.com/b/sparql", "vocab": "http://ex.com/b", "sleep": 0.2},
+        "c": {"source": "FAKE", "sparql_endpoint": "http://ex.com/c/sparql", "vocab": "http://ex.com/c", "fail": True},
+        "d": {"source": "FAKE", "sparql_endpoint": "http://ex.com/d/sparql", "vocab": "http://ex.com/d", "sleep": 1,
+              "collect_timeout": 0.1},
+    })
+    REGISTRY.swap({"http://ex.com/c1": SimpleNamespace(sparql_endpoint="http://ex.com/c/sparql")})
+    try:
+        started = time.time()
+        vocabs = utils.collect_vocabs()
+        # sources are collected from concurrently, and those that fail keep their previous vocabs
+        assert time.time() - started < 0.4
+        assert list(vocabs) == ["http://ex.com/a", "http://ex.com/b", "http://ex.com/c1"]
+    finally:
+        REGISTRY.clear()
+
+
+def test_collect_types_and_search_index(monkeypatch):
+    skos = "http://www.w3.org/2004/02/skos/core#"
+    monkeypatch.setattr(utils.source, "FAKE", FakeSource, raising=False)
+    monkeypatch.setattr(utils.config, "DATA_SOURCES", {
+        "a": {"source": "FAKE", "sparql_endpoint": "http://ex.com/a/sparql", "vocab": "http://ex.com/a"},
+        "c": {"source": "FAKE", "sparql_endpoint": "http://ex.com/c/sparql", "vocab": "http://ex.com/c", "fail": True},
+    })
+    previous_index = SearchIndex()
+    previous_index.add("http://ex.com/c1", "http://ex.com/c1/x", SearchIndex.PREF_LABEL, "Kept")
+    previous_index.add("http://ex.com/z", "http://ex.com/z/x", SearchIndex.PREF_LABEL, "Dropped")
+    REGISTRY.swap(
+        {
+            "http://ex.com/c1": SimpleNamespace(sparql_endpoint="http://ex.com/c/sparql"),
+            "http://ex.com/z": SimpleNamespace(sparql_endpoint="http://ex.com/z/sparql"),
+        },
+        search_index=previous_index,
+        types={
+            "http://ex.com/c1/x": (skos + "Concept", "http://ex.com/c1"),
+            "http://ex.com/z/x": (skos + "Concept", "http://ex.com/z"),
+        },
+    )
+    try:
+        # the sources that succeed are merged, and those that fail keep what they had before
+        assert utils.collect_types() == {
+            "http://ex.com/a/c": (skos + "Concept", "http://ex.com/a"),
+            "http://ex.com/c1/x": (skos + "Concept", "http://ex.com/c1"),
+        }
+        search_index = utils.collect_search_index()
+        assert search_index.search("Concept") == {"http://ex.com/a": [("http://ex.com/a/c", "Concept")]}
+        assert search_index.search("Kept") == {"http://ex.com/c1": [("http://ex.com/c1/x", "Kept")]}
+        assert not search_index.search("Dropped")
+
+        monkeypatch.setitem(utils.config.DATA_SOURCES["a"], "fail", True)
+        with pytest.raises(ValueError):
+            utils.collect_types()
+    finally:
+        REGISTRY.clear()
+
+
+def test_make_concept():
+    from vocprez.source import Source
+
+    skos = "http://www.w3.org/2004/02/skos/core#"
+    concept = Source._make_concept("http://ex.com/v", "http://ex.com/v/c1", [
+        ("http://www.w3.org/1999/02/22-rdf-syntax-ns#type", skos + "Concept", None, None),
+        (skos + "prefLabel", "Concept 1", "preferred label", None),
+        (skos + "definition", "The first", None, None),
+        (skos + "broader", "http://ex.com/v/c0", None, "Concept 0"),
+        (skos + "broader", "http://ex.com/v/c00", "has broader", None),
+        (skos + "notation", "C1", None, None),
+    ])
+    assert concept.to_dict() == {
+        "uri": "http://ex.com/v/c1",
+        "vocab_uri": "http://ex.com/v",
+        "prefLabel": "Concept 1",
+        "definition": "The first",
+        "related_instances": [
+            {"uri": skos + "broader", "label": "Broader", "value": "http://ex.com/v/c0", "value_label": "Concept 0"},
+            {"uri": skos + "broader", "label": "has broader", "value": "http://ex.com/v/c00", "value_label": None},
+        ],
+        "annotations": [{"uri": skos + "notation", "label": "Notation", "value": "C1", "value_label": None}],
+        "other_properties": [],
+    }
+
+
+class FakeUpstream:
+    def __init__(self, body, headers=None):
+        self.body = body
+        self.headers = headers or {}
+        self.status_code = 200
+        self.raw = self
+        self.closed = False
+
+    def stream(self, size, decode_content=False):
+        for i in range(0, len(self.body), 1024):
+            yield self.body[i:i + 1024]
+
+    def close(self):
+        self.closed = True
+
+
+def test_proxy_response():
+    body = b"".join(b"<http://ex.com/c%d>\n" % i for i in range(1000))
+
+    upstream = FakeUpstream(body, {"Content-Type": "text/tab-separated-values"})
+    response = utils.proxy_response(upstream, "application/json", gzip=True)
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert response.headers["Content-Type"] == "text/tab-separated-values"
+    assert gzip.decompress(b"".join(response.response)) == body
+    assert upstream.closed
+
+    # cut off responses are aborted with an error, not ended as if they were complete
+    upstream = FakeUpstream(body)
+    response = utils.proxy_response(upstream, "application/json", max_bytes=len(body) // 2, gzip=True)
+    sent = []
+    with pytest.raises(IOError):
+        for chunk in response.response:
+            sent.append(chunk)
+    assert upstream.closed
+    # what was sent decompresses to the start of the body, but is not a complete gzip stream
+    decompressor = zlib.decompressobj(wbits=31)
+    received = decompressor.decompress(b"".join(sent))
+    assert len(received) >= len(body) // 2 - 1024 and body.startswith(received)
+    assert not decompressor.eof
+
+    upstream = FakeUpstream(body)
+    with pytest.raises(IOError):
+        b"".join(utils.proxy_response(upstream, "application/json", timeout=-1).response)
+
+    # responses known to be too large aren't started
+    upstream = FakeUpstream(body, {"Content-Length": str(len(body))})
+    assert utils.proxy_response(upstream, "application/json", max_bytes=len(body) - 1).status_code == 502
+    assert upstream.closed
+
+
+def test_sparql_proxy_cache_key():
+    q = 'SELECT  * # all\nWHERE {\n  ?s <http://ex.com/p#q> "a  b # c" .\n}'
+    REGISTRY.swap({}, generation="a")
+    try:
+        assert utils.sparql_proxy_cache_key(q, "text/csv", "gzip") == \
+            'a|SELECT * WHERE { ?s <http://ex.com/p#q> "a  b # c" . }|text/csv|gzip'
+        assert utils.sparql_proxy_cache_key(q, "text/csv", "") != utils.sparql_proxy_cache_key(q, "text/turtle", "")
+
+        # results from before a reload aren't served after it
+        before = utils.sparql_proxy_cache_key(q, "text/csv", "")
+        REGISTRY.swap({}, generation="b")
+        assert utils.sparql_proxy_cache_key(q, "text/csv", "") != before
+    finally:
+        REGISTRY.clear()
+
+
+def test_limit_sparql_query():
+    assert utils.limit_sparql_query("SELECT * WHERE { ?s ?p ?o }", 10) == "SELECT * WHERE { ?s ?p ?o }\nLIMIT 10"
+    assert utils.limit_sparql_query("SELECT * WHERE { ?s ?p ?o } ORDER BY ?s # c\n", 10) == \
+        "SELECT * WHERE { ?s ?p ?o } ORDER BY ?s\nLIMIT 10 # c\n"
+    assert utils.limit_sparql_query("SELECT * WHERE { ?s ?p ?o } LIMIT 5", 10) == "SELECT * WHERE { ?s ?p ?o } LIMIT 5"
+    assert utils.limit_sparql_query("SELECT * WHERE { ?s ?p ?o } limit 50 OFFSET 5", 10) == \
+        "SELECT * WHERE { ?s ?p ?o } limit 10 OFFSET 5"
+    assert utils.limit_sparql_query("SELECT * WHERE { ?s ?p ?o } VALUES ?s { <x> }", 10) == \
+        "SELECT * WHERE { ?s ?p ?o } VALUES ?s { <x> }"
+    assert utils.limit_sparql_query("ASK { ?s ?p ?o }", 10) == "ASK { ?s ?p ?o }"
+    # a "#" in an IRI or string literal is not a comment, so one-line queries using them are limited too
+    q = "PREFIX skos: <http://www.w3.org/2004/02/skos/core#> SELECT * WHERE {?s ?p ?o}"
+    assert utils.limit_sparql_query(q, 10) == q + "\nLIMIT 10"
+    q = 'SELECT * WHERE { ?s ?p "#1" }'
+    assert utils.limit_sparql_query(q, 10) == q + "\nLIMIT 10"
+    q = 'SELECT * WHERE { ?s <http://ex.com/p#q> ?o } ORDER BY ?o # by "#o"'
+    assert utils.limit_sparql_query(q, 10) == 'SELECT * WHERE { ?s <http://ex.com/p#q> ?o } ORDER BY ?o\nLIMIT 10 # by "#o"'
+    assert utils.limit_sparql_query("SELECT * WHERE { ?s ?p ?o }", None) == "SELECT * WHERE { ?s ?p ?o }"
@@ -20,9 +20,7 @@ def client():
     app.testing = True
     with app.test_client() as client:
         with app.app_context():
-            g.VOCABS = {}
-            File.collect(TEST_SOURCE)
-            cache_write(g.VOCABS)
+            cache_write(File.collect(TEST_SOURCE))
         yield client
 
 
@@ -69,8 +67,7 @@ def test_alt_profiles_html(client):
 def manual_checker(endpoint):
     client = app.test_client()
     with app.app_context():
-        g.VOCABS = {}
-        File.collect(TEST_SOURCE)
+        g.VOCABS = File.collect(TEST_SOURCE)
         content = client.get(endpoint)
         dc = content.data.decode("utf-8")
     return dc
@@ -5,13 +5,48 @@ SKIN_DIR = path.join(APP_DIR, "view")
 TEMPLATES_DIR = path.join(SKIN_DIR, "templates")
 STATIC_DIR = path.join(SKIN_DIR, "style")
 LOGFILE = APP_DIR + "/vocprez.log"
-CACHE_FILE = path.join(APP_DIR, "cache", "DATA.p")
+CACHE_FILE = path.join(APP_DIR, "cache", "DATA.idx")  # the vocab index, in the format of vocprez/index.py
 CACHE_HOURS = 1
+CACHE_REFRESH_RETRY_SECONDS = 900  # Seconds after a failed background refresh of the cache before another is tried
+GRAPH_CACHE_DIR = path.join(APP_DIR, "cache", "graphs")  # full RDF graphs of individual vocabs
+GRAPH_CACHE_MAX_ITEMS = 20
+GRAPH_CACHE_MAX_BYTES = 500 * 1024 * 1024
+VOCAB_CACHE_MAX_ITEMS = 200  # concept indexes, hierarchies & Collection lists of vocabs held in memory by each process
+RESPONSE_CACHE_MAX_ITEMS = 1000  # rendered responses held in memory by each process
+RESPONSE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+RESPONSE_CACHE_DIR = None  # set to a directory to spill responses evicted from memory to disk
+RESPONSE_CACHE_DIR_MAX_BYTES = 1024 * 1024 * 1024
+CACHE_CONTROL = "public, max-age=300"  # Cache-Control header for vocab, Concept and Collection responses
 DEFAULT_LANGUAGE = "en"
 SPARQL_QUERY_LIMIT = 2000  # Maximum number of results to return per SPARQL query
 MAX_RETRIES = 2
 RETRY_SLEEP_SECONDS = 10
 SPARQL_TIMEOUT = 60
+SPARQL_POOL_SIZE = 10  # Maximum number of kept-alive connections to each SPARQL endpoint
+SPARQL_KEEP_ALIVE = True
+SPARQL_PROXY_TIMEOUT = 60  # Seconds a query through /endpoint may take, including streaming its results
+SPARQL_PROXY_MAX_BYTES = 500 * 1024 * 1024  # Results through /endpoint are cut off after this many bytes
+# Admission control for /endpoint, over all worker processes. Keep SPARQL_PROXY_CONCURRENCY plus SPARQL_PROXY_QUEUE_SIZE
+# below the number of workers (times threads per worker, with gunicorn's gthread workers) so that some are always free
+# for page views
+SPARQL_PROXY_CONCURRENCY = 2  # Queries through /endpoint run at once
+SPARQL_PROXY_CLIENT_CONCURRENCY = 1  # Queries through /endpoint run at once for any one client
+# Clients are told apart by their IP address. Behind a reverse proxy every request comes from the proxy's address, so
+# all clients would share the one client's limit: set REVERSE_PROXIES to the number of proxies in front of VocPrez that
+# set X-Forwarded-For, so that the app is wrapped in werkzeug's ProxyFix and sees the clients' own addresses
+REVERSE_PROXIES = 0
+SPARQL_PROXY_QUEUE_SIZE = 1  # Queries through /endpoint waiting for a turn. More get a 503 straight away
+SPARQL_PROXY_QUEUE_SECONDS = 5  # Seconds a query waits for a turn before getting a 503
+SPARQL_PROXY_SLOTS_DIR = path.join(APP_DIR, "cache", "slots")
+SPARQL_PROXY_CACHE = False  # Whether to cache the results of queries through /endpoint
+SPARQL_PROXY_CACHE_TTL = 300  # Seconds a cached query result is served for
+SPARQL_PROXY_CACHE_MAX_ITEMS = 1000
+SPARQL_PROXY_CACHE_MAX_BYTES = 64 * 1024 * 1024
+COLLECT_TIMEOUT = 300  # Seconds each data source is given to list its vocabs, objects or labels, unless it sets its own
+COLLECT_PAGE_SIZE = 500  # ConceptSchemes listed per query when collecting the vocabs of a SPARQL source
+GET_CONCEPTS_BATCH_SIZE = 100  # Concepts fetched per query by get_concepts(), e.g. for the /concepts route
+GET_CONCEPTS_MAX_URIS = 1000  # Concepts that one request to the /concepts route may ask for
+SPARQL_QUERY_THREADS = 8  # Threads per process for running a page's independent SPARQL queries concurrently
 PORT = 5000
 
 
@@ -47,6 +82,8 @@ DATA_SOURCES = {
         "sparql_endpoint": SPARQL_ENDPOINT,
         "sparql_username": SPARQL_USERNAME,
         "sparql_password": SPARQL_PASSWORD,
+        # "collect_timeout": 600,  # Optional, overrides COLLECT_TIMEOUT for this source
+        # "collect_page_size": 100,  # Optional, overrides COLLECT_PAGE_SIZE for this source
     },
 }
 
@@ -0,0 +1,97 @@
+import hashlib
+import logging
+import os
+import time
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows, where nothing is limited
+    fcntl = None
+
+
+__all__ = [
+    "SlotLimiter",
+]
+
+
+class SlotLimiter:
+    """
+    Limits how many of something may happen at once over all processes on a host (e.g. all gunicorn workers), with a
+    fixed number of lock files as slots. A slot is taken by holding an exclusive lock on its file, so the slots of a
+    process that dies are freed by the OS.
+
+    Slots may be kept per name, e.g. per client, with each name getting its own set of slots. A named slot's file is
+    removed when the slot is given back, so that the directory doesn't keep a file for every name ever seen.
+    """
+
+    POLL_SECONDS = 0.05
+
+    def __init__(self, directory, slots=None):
+        """
+        :param directory: where the slot files are kept
+        :param slots: the number of slots (per name), or None for no limit
+        """
+        self.directory = directory
+        self.slots = slots
+
+    def acquire(self, name=None, wait=0):
+        """
+        Takes a slot, waiting up to wait seconds for one to come free
+
+        :param name: takes one of this name's slots rather than the shared ones
+        :param wait: seconds to wait for a free slot
+        :return: a function that gives the slot back, or None if no slot came free in time
+        """
+        if self.slots is None or fcntl is None:
+            return lambda: None
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory, exist_ok=True)
+
+        prefix = hashlib.sha1(name.encode("utf-8")).hexdigest()[:16] if name else "shared"
+        deadline = time.time() + wait
+        while True:
+            for i in range(self.slots):
+                path = os.path.join(self.directory, "{}.{}.lock".format(prefix, i))
+                slot_file = self._lock(path)
+                if slot_file is not None:
+                    return self._releaser(slot_file, path if name else None)
+
+            if time.time() >= deadline:
+                logging.debug("no free slot in {} for {}".format(self.directory, name))
+                return None
+            time.sleep(self.POLL_SECONDS)
+
+    @staticmethod
+    def _lock(path):
+        """Locks the slot file at path, returning it open, or None if another process holds it"""
+        while True:
+            slot_file = open(path, "a")
+            try:
+                fcntl.flock(slot_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                slot_file.close()
+                return None
+
+            # the file may have been removed by the process giving the slot back between being opened and locked here,
+            # in which case the lock is on a file no other process can find, and the slot is tried again
+            try:
+                if os.stat(path).st_ino == os.fstat(slot_file.fileno()).st_ino:
+                    return slot_file
+            except FileNotFoundError:
+                pass
+            slot_file.close()
+
+    @staticmethod
+    def _releaser(slot_file, remove=None):
+        def release():
+            if not slot_file.closed:
+                if remove is not None:
+                    # removed while still locked, so that no other process can take the slot from this file after
+                    try:
+                        os.unlink(remove)
+                    except FileNotFoundError:
+                        pass
+                fcntl.flock(slot_file, fcntl.LOCK_UN)
+                slot_file.close()
+        return release
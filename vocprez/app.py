@@ -1,8 +1,9 @@
 import sys
 
+import functools
 import io
+import time
 import json
-import requests
 from rdflib import Graph
 from flask import (
     Flask,
@@ -24,6 +25,7 @@ import vocprez.source as source
 import markdown
 from flask_compress import Compress
 from flaskext.markdown import Markdown
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 logging.basicConfig(
     filename=config.LOGFILE,
@@ -45,14 +47,18 @@ app.config["COMPRESS_MIMETYPES"] = [
 ] + Renderer.RDF_MEDIA_TYPES
 Compress(app)
 Markdown(app)
+if getattr(config, "REVERSE_PROXIES", 0):
+    # request.remote_addr is then the client's address from X-Forwarded-For, rather than the proxy's
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=config.REVERSE_PROXIES)
 
 
 # FUNCTION before_request
 @app.before_request
 def before_request():
     """
-    Runs before every request and populates vocab index either from disk (VOCABS.p) or from a complete reload by
-    calling collect() for each of the vocab sources defined in config/__init__.py -> VOCAB_SOURCES
+    Runs before every request and points g.VOCABS at the process-level vocab registry, loading it first if this process
+    hasn't yet, either from disk (CACHE_FILE) or from a complete reload by calling collect() for each of the vocab
+    sources defined in config/__init__.py -> DATA_SOURCES
     :return: nothing
     """
     logging.debug("before_request()")
@@ -60,9 +66,6 @@ def before_request():
     # always rebuild if DEBUG True
     if config.DEBUG:
         u.cache_reload()
-    elif hasattr(g, "VOCABS"):
-        # if g.VOCABS exists, if so, do nothing
-        pass
     else:
         u.cache_load()
 # END FUNCTION before_request
@@ -82,8 +85,92 @@ def context_processor():
 # END FUNCTION context_processor
 
 
+# FUNCTION cache_response
+def cache_response(route):
+    """
+    Decorator for routes whose responses only change when the vocab index is reloaded. Successful responses are kept in
+    the process' RESPONSE_CACHE and served from there to later requests with the same arguments and content negotiation
+    headers, until the vocab index is reloaded. Responses marked as partial with u.mark_response_partial() are not kept.
+    """
+    @functools.wraps(route)
+    def cached_route(*args, **kwargs):
+        if config.DEBUG:
+            return route(*args, **kwargs)
+
+        key = u.response_cache_key(request)
+        cached = u.RESPONSE_CACHE.get(key)
+        if cached is not None:
+            body, status, headers = cached
+            return Response(body, status=status, headers=headers)
+
+        response = route(*args, **kwargs)
+        if isinstance(response, Response) and response.status_code == 200 and not response.is_streamed \
+                and not u.response_is_partial():
+            u.RESPONSE_CACHE.put(key, (response.get_data(), response.status_code, list(response.headers.items())))
+        return response
+
+    return cached_route
+# END FUNCTION cache_response
+
+
+# FUNCTION conditional
+def conditional(route):
+    """
+    Decorator for routes whose responses only change when the vocab index is reloaded. Successful responses are given
+    an ETag, a Last-Modified date and Cache-Control hints, and conditional GETs (If-None-Match or If-Modified-Since) are
+    answered with 304 Not Modified before the route does any work. Responses marked as partial with
+    u.mark_response_partial() are given none of these, so that clients don't keep them.
+    """
+    @functools.wraps(route)
+    def conditional_route(*args, **kwargs):
+        if request.method not in ("GET", "HEAD"):
+            return route(*args, **kwargs)
+
+        etag = u.response_etag(request)
+        last_modified = u.get_last_modified(uri=request.values.get("uri"), vocab_id=kwargs.get("vocab_id"))
+        headers = {
+            "Cache-Control": getattr(config, "CACHE_CONTROL", "public, max-age=300"),
+            "Vary": "Accept, Accept-Profile, Accept-Language",
+        }
+
+        # If-None-Match takes precedence over If-Modified-Since, as per RFC 7232. Compress appends the content coding
+        # to the ETags of compressed responses, so those are matched too
+        matched_etag = None
+        if request.if_none_match:
+            for tag in [etag] + ["{}:{}".format(etag, coding) for coding in ("gzip", "br", "deflate")]:
+                if request.if_none_match.contains(tag):
+                    matched_etag = tag
+                    break
+            not_modified = matched_etag is not None
+        else:
+            not_modified = (
+                last_modified is not None
+                and request.if_modified_since is not None
+                and last_modified.replace(microsecond=0) <= request.if_modified_since
+            )
+        if not_modified:
+            response = Response(status=304, headers=headers)
+            response.set_etag(matched_etag or etag)
+            if last_modified is not None:
+                response.last_modified = last_modified
+            return response
+
+        response = route(*args, **kwargs)
+        if isinstance(response, Response) and response.status_code == 200 and not u.response_is_partial():
+            response.set_etag(etag)
+            if last_modified is not None:
+                response.last_modified = last_modified
+            response.headers.update(headers)
+        return response
+
+    return conditional_route
+# END FUNCTION conditional
+
+
 # ROUTE index
 @app.route("/")
+@conditional
+@cache_response
 def index():
     return VocPrezRenderer(
         request,
@@ -98,6 +185,8 @@ def index():
 
 # ROUTE vocabs
 @app.route("/vocab/")
+@conditional
+@cache_response
 def vocabularies():
     return VocabulariesRenderer(
         request,
@@ -134,6 +223,7 @@ def vocabulary(vocab_id):
 
 # ROUTE concepts
 @app.route("/vocab/<vocab_id>/concept/")
+@conditional
 def concepts(vocab_id):
     if vocab_id not in [x.id for x in g.VOCABS.values()]:
         return return_vocprez_error(
@@ -149,9 +239,10 @@ def concepts(vocab_id):
         )
 
     try:
-        vocab_source = getattr(source, g.VOCABS[vocab_id].source)(vocab_id, request)
-        cpts = vocab_source.list_concepts()
-        # concepts.sort(key=lambda x: x["prefLabel"]) -- sort not needed when receiving pre-sorted tuples
+        vocab = [v for v in g.VOCABS.values() if v.id == vocab_id][0]
+        vocab_source = getattr(source, vocab.source)(request)
+        # the index is held in memory, sorted by prefLabel, so a page is just a slice of it
+        cpts = vocab_source.get_concept_index(vocab.uri)
         total = len(cpts)
 
         page = (
@@ -187,6 +278,8 @@ def concepts(vocab_id):
 
 # ROUTE object
 @app.route("/object")
+@conditional
+@cache_response
 def object():
     """
     This is the general RESTful endpoint and corresponding Python function to handle requests for individual objects,
@@ -215,40 +308,49 @@ def object():
     if uri == config.VOCS_URI or uri == config.VOCS_URI + "/":
         return vocabularies()
 
-    # get the class of the object
-    q = """
-        PREFIX skos: <http://www.w3.org/2004/02/skos/core#>
+    # get the class of the object, from the in-memory type map if it knows it, else from the SPARQL endpoint
+    object_type = u.get_object_type(uri)
+    if object_type is not None:
+        object_types = [object_type]
+    else:
+        q = """
+            PREFIX skos: <http://www.w3.org/2004/02/skos/core#>
 
-        SELECT DISTINCT ?c ?cs
-        WHERE {
-            GRAPH ?g {
-                <xxx> a ?c .
-                OPTIONAL {
-                    VALUES ?memberof { skos:inScheme skos:topConceptOf }
-                    <xxx> ?memberof ?cs .
+            SELECT DISTINCT ?c ?cs
+            WHERE {
+                GRAPH ?g {
+                    <xxx> a ?c .
+                    OPTIONAL {
+                        VALUES ?memberof { skos:inScheme skos:topConceptOf }
+                        <xxx> ?memberof ?cs .
+                    }
                 }
             }
-        }
-        """.replace("xxx", uri)
+            """.replace("xxx", uri)
+        object_types = [
+            (r["c"]["value"], r["cs"]["value"] if r.get("cs") else None)
+            for r in u.sparql_query(q)
+        ]
+
     cs = None
-    for r in u.sparql_query(q):
-        if r["c"]["value"] == "http://www.w3.org/2004/02/skos/core#ConceptScheme":
+    for c, memberof in object_types:
+        if c == "http://www.w3.org/2004/02/skos/core#ConceptScheme":
             if uri in g.VOCABS.keys():
                 # get vocab details using appropriate source handler
                 vocab = source.SPARQL(request).get_vocabulary(uri)
                 return VocabularyRenderer(request, vocab).render()
             else:
                 return None
-        elif r["c"]["value"] == "http://www.w3.org/2004/02/skos/core#Collection":
+        elif c == "http://www.w3.org/2004/02/skos/core#Collection":
             try:
                 c = source.SPARQL(request).get_collection(uri)
                 return CollectionRenderer(request, c).render()
             except:
                 return None
-        elif r["c"]["value"] == "http://www.w3.org/2004/02/skos/core#Concept":
+        elif c == "http://www.w3.org/2004/02/skos/core#Concept":
             try:
-                if r.get("cs"):
-                    cs = r["cs"]["value"]
+                if memberof:
+                    cs = memberof
                 c = source.SPARQL(request).get_concept(cs, uri)
                 return ConceptRenderer(request, c).render()
             except Exception as e:
@@ -263,6 +365,61 @@ def object():
 # END ROUTE object
 
 
+# ROUTE concepts_batch
+@app.route("/concepts", methods=["GET", "POST"])
+def concepts_batch():
+    """
+    Several Concepts, from any vocabs, as JSON, fetched with one query per vocab (per GET_CONCEPTS_BATCH_SIZE Concepts)
+    rather than a request per Concept. Each Concept wanted is given by a 'uri' query string or form argument, which may
+    be repeated up to GET_CONCEPTS_MAX_URIS times
+
+    :return: A Flask Response object, of a JSON object with the list of Concepts found, the URIs of those not found and
+    any given that aren't IRIs
+    :rtype: :class:`flask.Response`
+    """
+    uris = list(dict.fromkeys(request.values.getlist("uri")))
+    if not uris:
+        return return_vocprez_error(
+            "Input Error",
+            400,
+            "At least one Query String Argument of 'uri' must be supplied for this endpoint"
+        )
+    max_uris = getattr(config, "GET_CONCEPTS_MAX_URIS", 1000)
+    if len(uris) > max_uris:
+        return return_vocprez_error(
+            "Input Error",
+            400,
+            "No more than {} Concepts may be requested at once".format(max_uris)
+        )
+
+    # URIs that can't be IRIs are reported apart, rather than put in, and breaking, the queries for the others
+    invalid = [uri for uri in uris if not u.is_iri(uri)]
+    uris = [uri for uri in uris if u.is_iri(uri)]
+
+    # group the Concepts by vocab, as known by the in-memory type map or else the SPARQL endpoint
+    by_vocab = {}
+    for uri, object_types in u.get_object_types(uris).items():
+        for c, cs in object_types:
+            if c == "http://www.w3.org/2004/02/skos/core#Concept" and cs in g.VOCABS:
+                by_vocab.setdefault(cs, []).append(uri)
+                break
+
+    found = {}
+    for vocab_uri, vocab_concepts in by_vocab.items():
+        found.update(source.SPARQL(request).get_concepts(vocab_uri, vocab_concepts))
+
+    return Response(
+        json.dumps({
+            "concepts": [found[uri].to_dict() for uri in uris if uri in found],
+            "not_found": [uri for uri in uris if uri not in found],
+            "invalid": invalid,
+        }),
+        status=200,
+        mimetype="application/json"
+    )
+# END ROUTE concepts_batch
+
+
 # ROUTE about
 @app.route("/about")
 def about():
@@ -322,70 +479,19 @@ def search():
     if request.values.get("search"):
         last_search = request.values.get("search")
         if request.values.get("from") and request.values.get("from") != "all":
-            grf = '<' + request.values.get("from") + '>'
-            bind = f"BIND ({grf} AS ?g)"
+            grf = request.values.get("from")
         else:
-            grf = "?g"
-            bind = ""
-        q = """
-            PREFIX skos: <http://www.w3.org/2004/02/skos/core#>
-
-            SELECT DISTINCT ?g ?uri ?pl (SUM(?w) AS ?weight)
-            WHERE {{                
-                GRAPH {grf} {{
-                    {{  # exact match on a prefLabel always wins
-                        ?uri a skos:Concept ;
-                             skos:prefLabel ?pl .
-                        BIND (50 AS ?w)
-                        FILTER REGEX(?pl, "^{input}$", "i")
-                    }}
-                    UNION    
-                    {{
-                        ?uri a skos:Concept ;
-                             skos:prefLabel ?pl .
-                        BIND (10 AS ?w)
-                        FILTER REGEX(?pl, "{input}", "i")
-                    }}
-                    UNION
-                    {{
-                        ?uri a skos:Concept ;
-                             skos:altLabel ?al ;
-                             skos:prefLabel ?pl .
-                        BIND (5 AS ?w)
-                        FILTER REGEX(?al, "{input}", "i")
-                    }}
-                    UNION
-                    {{
-                        ?uri a skos:Concept ;
-                             skos:hiddenLabel ?hl ;
-                             skos:prefLabel ?pl .
-                        BIND (5 AS ?w)
-                        FILTER REGEX(?hl, "{input}", "i")
-                    }}        
-                    UNION
-                    {{
-                        ?uri a skos:Concept ;
-                             skos:definition ?d ;
-                             skos:prefLabel ?pl .
-                        BIND (1 AS ?w)
-                        FILTER REGEX(?d, "{input}", "i")
-                    }}        
-                }}
-                
-                {bind}
-            }}
-            GROUP BY ?g ?uri ?pl
-            ORDER BY DESC(?weight) 
-            """.format(**{"grf": grf, "input": request.values.get("search"), "bind": bind})
-        results = {}
-
-        for r in u.sparql_query(q):
-            if r.get("uri") is None:
-                break  # must do this check as r["weight"] will appear at least once with value 0 for no results
-
-            if r["g"]["value"] not in results.keys():
-                results[r["g"]["value"]] = []
-            results[r["g"]["value"]].append((r["uri"]["value"], r["pl"]["value"]))
+            grf = None
+
+        # searched in the in-process index of all Concepts' labels, with no query sent to the SPARQL endpoint
+        search_index = u.get_search_index()
+        if search_index is None:
+            return return_vocprez_error(
+                "Search Unavailable",
+                503,
+                "The search index is not available at the moment. Please try again later."
+            )
+        results = search_index.search(last_search, graph=grf)
 
         return render_template(
             "search.html",
@@ -472,40 +578,77 @@ def endpoint():
                 "Input parameter rdf_format must be one of: " + ", ".join(rdf_formats)
             )
 
-    def sparql_query2(q, mimetype="application/json"):
-        """ Make a SPARQL query"""
+    def sparql_query2(q, mimetype="application/json", headers=None):
+        """ Make a SPARQL query, streaming the endpoint's response back as it arrives"""
         logging.debug("sparql_query2: {}".format(q))
-        data = q
+        data = u.limit_sparql_query(q, getattr(config, "SPARQL_QUERY_LIMIT", None))
 
-        headers = {
+        accept_encoding = request.headers.get("Accept-Encoding", "")
+        upstream_headers = {
             "Content-Type": "application/sparql-query",
             "Accept": mimetype,
-            "Accept-Encoding": "UTF-8",
+            # the endpoint's encoding is passed through, so ask only for encodings the client accepts
+            "Accept-Encoding": accept_encoding or "identity",
         }
-        if config.SPARQL_USERNAME is not None and config.SPARQL_PASSWORD is not None:
-            auth = (config.SPARQL_USERNAME, config.SPARQL_PASSWORD)
-        else:
-            auth = None
+        headers = dict(headers or {})
+
+        cache_key = None
+        if u.SPARQL_PROXY_CACHE is not None:
+            cache_key = u.sparql_proxy_cache_key(q, mimetype, upstream_headers["Accept-Encoding"])
+            cached = u.SPARQL_PROXY_CACHE.get(cache_key)
+            if cached is not None:
+                body, status, content_type, content_encoding = cached
+                headers["X-Cache"] = "HIT"
+                headers["Vary"] = "Accept-Encoding"
+                if content_encoding is not None:
+                    headers["Content-Encoding"] = content_encoding
+                return Response(body, status=status, content_type=content_type, headers=headers)
+            headers["X-Cache"] = "MISS"
+
+        # request.remote_addr is the client's address if REVERSE_PROXIES is set when behind a reverse proxy
+        release = u.admit_sparql_query(request.remote_addr)
+        if release is None:
+            return Response(
+                "Too many SPARQL queries are being run at the moment. Please try again shortly.",
+                status=503,
+                mimetype="text/plain",
+                headers={"Retry-After": "5"},
+            )
+
+        session = u.get_sparql_session(config.SPARQL_ENDPOINT, config.SPARQL_USERNAME, config.SPARQL_PASSWORD)
+        timeout = getattr(config, "SPARQL_PROXY_TIMEOUT", 60)
 
         try:
             logging.debug(
                 "endpoint={}\ndata={}\nheaders={}".format(
-                    config.SPARQL_ENDPOINT, data, headers
+                    config.SPARQL_ENDPOINT, data, upstream_headers
                 )
             )
-            if auth is not None:
-                r = requests.post(
-                    config.SPARQL_ENDPOINT, auth=auth, data=data, headers=headers, timeout=60
-                )
-            else:
-                r = requests.post(
-                    config.SPARQL_ENDPOINT, data=data, headers=headers, timeout=60
-                )
-            logging.debug("response: {}".format(r.__dict__))
-            return r.content.decode("utf-8")
+            r = session.post(
+                config.SPARQL_ENDPOINT,
+                data=data.encode("utf-8"),
+                headers=upstream_headers,
+                timeout=timeout,
+                stream=True,
+            )
+            logging.debug("response: {} {}".format(r.status_code, r.headers))
+            response = u.proxy_response(
+                r,
+                mimetype,
+                max_bytes=getattr(config, "SPARQL_PROXY_MAX_BYTES", None),
+                timeout=timeout,
+                gzip="gzip" in accept_encoding,
+                headers=headers,
+                cache_key=cache_key,
+            )
         except Exception as ex:
+            release()
             raise ex
 
+        # the query keeps its turn until its results have been streamed to the client
+        response.call_on_close(release)
+        return response
+
     format_mimetype = request.headers["ACCEPT"]
 
     # Query submitted
@@ -566,18 +709,9 @@ def endpoint():
         try:
             if "CONSTRUCT" in query:
                 format_mimetype = "text/turtle"
-                return Response(
-                    sparql_query2(
-                        query, mimetype=format_mimetype
-                    ),
-                    status=200,
-                    mimetype=format_mimetype,
-                )
+                return sparql_query2(query, mimetype=format_mimetype)
             else:
-                return Response(
-                    sparql_query2(query, format_mimetype),
-                    status=200,
-                )
+                return sparql_query2(query, format_mimetype)
         except ValueError as e:
             return Response(
                 "Input error for query {}.\n\nError message: {}".format(query, str(e)),
@@ -606,9 +740,6 @@ def endpoint():
             if "CONSTRUCT" in query:
                 acceptable_mimes = [x for x in Renderer.RDF_MEDIA_TYPES]
                 best = request.accept_mimetypes.best_match(acceptable_mimes)
-                query_result = sparql_query2(
-                    query, mimetype=best
-                )
                 file_ext = {
                     "text/turtle": "ttl",
                     "application/rdf+xml": "rdf",
@@ -616,9 +747,8 @@ def endpoint():
                     "text/n3": "n3",
                     "application/n-triples": "nt",
                 }
-                return Response(
-                    query_result,
-                    status=200,
+                return sparql_query2(
+                    query,
                     mimetype=best,
                     headers={
                         "Content-Disposition": "attachment; filename=query_result.{}".format(
@@ -627,10 +757,7 @@ def endpoint():
                     },
                 )
             else:
-                query_result = sparql_query2(query)
-                return Response(
-                    query_result, status=200, mimetype="application/sparql-results+json"
-                )
+                return sparql_query2(query, mimetype="application/sparql-results+json")
         else:
             # SPARQL Service Description
             """
@@ -686,16 +813,29 @@ def return_vocprez_error(title, status, message):
 # ROUTE cache_reload
 @app.route("/cache-reload")
 def cache_reload():
-    u.cache_reload()
+    # only vocabs new or modified since the last build are re-fetched, unless a full reload is asked for with ?full
+    started = time.time()
+    u.cache_reload(full="full" in request.values)
 
     return Response(
-        "Cache reloaded",
+        "Cache reloaded in {:.2f} seconds".format(time.time() - started),
         status=200,
         mimetype="text/plain"
     )
 # END ROUTE cache_reload
 
 
+# ROUTE cache_stats
+@app.route("/cache-stats")
+def cache_stats():
+    stats = {"responses": u.RESPONSE_CACHE.stats()}
+    if u.SPARQL_PROXY_CACHE is not None:
+        stats["sparql"] = u.SPARQL_PROXY_CACHE.stats()
+
+    return Response(json.dumps(stats), status=200, mimetype="application/json")
+# END ROUTE cache_stats
+
+
 # run the Flask app
 if __name__ == "__main__":
     app.run(debug=config.DEBUG, threaded=True, port=config.PORT)
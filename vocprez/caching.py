@@ -0,0 +1,191 @@
+import hashlib
+import logging
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+
+__all__ = [
+    "DiskCache",
+    "LRUCache",
+]
+
+
+class DiskCache:
+    """
+    A directory of pickled objects, shared by all processes, with least-recently-used eviction once either the number
+    of items or their total size on disk goes over a limit.
+
+    Recency is tracked with file modification times, which get() refreshes, so no index file needs to be kept in sync
+    between processes.
+    """
+
+    def __init__(self, directory, max_items=None, max_bytes=None):
+        self.directory = directory
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".p")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                obj = pickle.load(f)
+            os.utime(path)  # mark as recently used
+            return obj
+        except FileNotFoundError:
+            return None
+        except (pickle.UnpicklingError, EOFError, OSError) as e:
+            logging.warning("Discarding unreadable cache entry {}: {}".format(path, e))
+            self._remove(path)
+            return None
+
+    def put(self, key, obj):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory, exist_ok=True)
+
+        path = self._path(key)
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp_path, "wb") as f:
+            pickle.dump(obj, f)
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        """Removes least recently used entries until the cache is within its limits"""
+        if self.max_items is None and self.max_bytes is None:
+            return
+
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".p"):
+                path = os.path.join(self.directory, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue  # removed by another process
+                entries.append((st.st_mtime, st.st_size, path))
+        entries.sort()
+
+        total_bytes = sum(e[1] for e in entries)
+        while entries and (
+                (self.max_items is not None and len(entries) > self.max_items)
+                or (self.max_bytes is not None and total_bytes > self.max_bytes)
+        ):
+            mtime, size, path = entries.pop(0)
+            logging.debug("evicting cache entry {}".format(path))
+            self._remove(path)
+            total_bytes -= size
+
+    def clear(self):
+        if os.path.isdir(self.directory):
+            for name in os.listdir(self.directory):
+                self._remove(os.path.join(self.directory, name))
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
+class LRUCache:
+    """
+    A thread-safe, in-memory cache with least-recently-used eviction once either the number of items or their total
+    size goes over a limit. Items may also expire a fixed time after they were put.
+
+    If given a DiskCache to spill to, evicted items are written to it and looked for there on a miss, so the cache can
+    hold more than fits in memory. Keys must then be strings.
+    """
+
+    def __init__(self, max_items=None, max_bytes=None, ttl=None, spill=None, sizeof=len):
+        """
+        :param max_items: maximum number of items held in memory
+        :param max_bytes: maximum total size of the items held in memory, as measured by sizeof
+        :param ttl: seconds after which an item expires
+        :param spill: a DiskCache to write evicted items to
+        :param sizeof: function returning the size of a value in bytes
+        """
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.spill = spill
+        self.sizeof = sizeof
+        self._items = OrderedDict()  # key -> (value, size, expiry time)
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                if item[2] is not None and item[2] < time.time():
+                    self._pop(key)
+                else:
+                    self._items.move_to_end(key)
+                    self.hits += 1
+                    return item[0]
+
+        if self.spill is not None:
+            value = self.spill.get(key)
+            if value is not None:
+                self.put(key, value)
+                with self._lock:
+                    self.hits += 1
+                return value
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return  # would evict everything else and still not fit
+
+        evicted = []
+        with self._lock:
+            if key in self._items:
+                self._pop(key)
+            self._items[key] = (value, size, time.time() + self.ttl if self.ttl is not None else None)
+            self.bytes += size
+            while (
+                    (self.max_items is not None and len(self._items) > self.max_items)
+                    or (self.max_bytes is not None and self.bytes > self.max_bytes)
+            ):
+                old_key = next(iter(self._items))
+                evicted.append((old_key, self._pop(old_key)))
+
+        if self.spill is not None:
+            for old_key, old_value in evicted:
+                self.spill.put(old_key, old_value)
+
+    def _pop(self, key):
+        value, size, expiry = self._items.pop(key)
+        self.bytes -= size
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.bytes = 0
+        if self.spill is not None:
+            self.spill.clear()
+
+    def stats(self):
+        return {
+            "items": len(self._items),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
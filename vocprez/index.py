@@ -0,0 +1,256 @@
+from collections.abc import Mapping
+import datetime
+import mmap
+import struct
+from vocprez.model.vocabulary import Vocabulary
+
+
+__all__ = [
+    "IndexFormatError",
+    "MappedIndex",
+    "MappedVocabs",
+    "write_index",
+]
+
+
+class IndexFormatError(ValueError):
+    pass
+
+
+# Layout of a vocab index file, all integers little-endian:
+#
+#   header      MAGIC, VERSION, the generation and the number of entries in and offset of each of the sections below
+#   strings     (offset, length) pairs locating each distinct string, UTF-8 encoded, in the string data
+#   vocabs      a record per Vocabulary: the string number of each of VOCAB_FIELDS, or NONE
+#   types       a record per object: the string numbers of its URI, class URI and ConceptScheme URI (or NONE), sorted by
+#               the object's URI, as UTF-8 bytes, so that an object can be looked up by binary search
+#   string data
+#
+# Nothing needs to be deserialised when the file is opened, so every process maps the same file into memory and shares
+# its pages through the OS' page cache, and opening it takes no time however many objects it holds.
+MAGIC = b"VPIX"
+VERSION = 1
+HEADER = struct.Struct("<4sI32sIQIQIQQ")
+STRING = struct.Struct("<QI")
+TYPE = struct.Struct("<III")
+NONE = 0xFFFFFFFF
+
+# the Vocabulary attributes stored. Others, such as concepts, are not set until a vocab is requested
+VOCAB_FIELDS = (
+    "id",
+    "uri",
+    "title",
+    "description",
+    "creator",
+    "created",
+    "modified",
+    "versionInfo",
+    "source",
+    "accessURL",
+    "downloadURL",
+    "sparql_endpoint",
+    "sparql_username",
+    "sparql_password",
+)
+DATE_FIELDS = ("created", "modified")
+VOCAB = struct.Struct("<" + "I" * len(VOCAB_FIELDS))
+
+
+def write_index(f, vocabs, generation, types=None):
+    """
+    Writes a vocab index to a file
+
+    :param f: a file opened for writing in binary mode
+    :param vocabs: dict of Vocabulary objects, keyed by vocab URI
+    :param generation: the identifier, of up to 32 ASCII characters, of this build of the index
+    :param types: dict of object URIs to (class URI, ConceptScheme URI) tuples, if known
+    """
+    strings = []
+    string_numbers = {}
+
+    def number(s):
+        if s is None:
+            return NONE
+        s = s.isoformat() if isinstance(s, datetime.date) else str(s)
+        n = string_numbers.get(s)
+        if n is None:
+            n = string_numbers[s] = len(strings)
+            strings.append(s)
+        return n
+
+    vocab_records = [
+        VOCAB.pack(*(number(getattr(vocab, field, None)) for field in VOCAB_FIELDS))
+        for vocab in vocabs.values()
+    ]
+    type_records = [
+        TYPE.pack(number(uri), number(cls), number(scheme))
+        for uri, (cls, scheme) in sorted((types or {}).items(), key=lambda item: item[0].encode("utf-8"))
+    ]
+
+    encoded = [s.encode("utf-8") for s in strings]
+    strings_offset = HEADER.size
+    vocabs_offset = strings_offset + STRING.size * len(encoded)
+    types_offset = vocabs_offset + VOCAB.size * len(vocab_records)
+    data_offset = types_offset + TYPE.size * len(type_records)
+
+    f.write(HEADER.pack(
+        MAGIC,
+        VERSION,
+        generation.encode("ascii"),
+        len(encoded),
+        strings_offset,
+        len(vocab_records),
+        vocabs_offset,
+        len(type_records) if types is not None else NONE,
+        types_offset,
+        data_offset,
+    ))
+    position = data_offset
+    for s in encoded:
+        f.write(STRING.pack(position, len(s)))
+        position += len(s)
+    for record in vocab_records:
+        f.write(record)
+    for record in type_records:
+        f.write(record)
+    for s in encoded:
+        f.write(s)
+
+
+class MappedIndex:
+    """
+    A vocab index file, written by write_index(), mapped read-only into memory
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            try:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:  # empty file
+                raise IndexFormatError("{} is empty".format(path))
+
+        if len(self._map) < HEADER.size:
+            raise IndexFormatError("{} is not a vocab index file".format(path))
+        (
+            magic,
+            version,
+            generation,
+            self._n_strings,
+            self._strings_offset,
+            self._n_vocabs,
+            self._vocabs_offset,
+            n_types,
+            self._types_offset,
+            self._data_offset,
+        ) = HEADER.unpack_from(self._map)
+        if magic != MAGIC:
+            raise IndexFormatError("{} is not a vocab index file".format(path))
+        if version != VERSION:
+            raise IndexFormatError("{} is a version {} vocab index file, not version {}".format(path, version, VERSION))
+
+        self.generation = generation.rstrip(b"\0").decode("ascii")
+        self.types = MappedTypes(self, n_types) if n_types != NONE else None
+
+    def _bytes(self, n):
+        offset, length = STRING.unpack_from(self._map, self._strings_offset + STRING.size * n)
+        return self._map[offset:offset + length]
+
+    def _string(self, n):
+        return self._bytes(n).decode("utf-8") if n != NONE else None
+
+    def vocabs(self):
+        """The Vocabulary objects, keyed by vocab URI, as a MappedVocabs"""
+        return MappedVocabs(self)
+
+    def _vocab(self, i):
+        fields = {
+            field: self._string(n)
+            for field, n in zip(VOCAB_FIELDS, VOCAB.unpack_from(self._map, self._vocabs_offset + VOCAB.size * i))
+        }
+        for field in DATE_FIELDS:
+            if fields[field] is not None:
+                fields[field] = datetime.datetime.fromisoformat(fields[field])
+        return Vocabulary(
+            fields.pop("id"),
+            fields.pop("uri"),
+            fields.pop("title"),
+            fields.pop("description"),
+            fields.pop("creator"),
+            fields.pop("created"),
+            fields.pop("modified"),
+            fields.pop("versionInfo"),
+            fields.pop("source"),
+            **fields
+        )
+
+
+class MappedVocabs(Mapping):
+    """
+    The read-only dict of Vocabulary objects in a MappedIndex, keyed by vocab URI and in the order written. Only the
+    vocabs' URIs are read when it is made: each Vocabulary is made from the index the first time it is asked for
+    """
+
+    def __init__(self, index):
+        self._index = index
+        uri_field = VOCAB_FIELDS.index("uri")
+        self._numbers = {
+            index._string(VOCAB.unpack_from(index._map, index._vocabs_offset + VOCAB.size * i)[uri_field]): i
+            for i in range(index._n_vocabs)
+        }
+        self._vocabs = {}
+
+    def __len__(self):
+        return len(self._numbers)
+
+    def __iter__(self):
+        return iter(self._numbers)
+
+    def __contains__(self, uri):
+        return uri in self._numbers
+
+    def __getitem__(self, uri):
+        vocab = self._vocabs.get(uri)
+        if vocab is None:
+            # made at most once per vocab, bar a harmless race between threads
+            vocab = self._vocabs[uri] = self._index._vocab(self._numbers[uri])
+        return vocab
+
+
+class MappedTypes:
+    """
+    The map of object URIs to (class URI, ConceptScheme URI) tuples in a MappedIndex, looked up in place
+    """
+
+    def __init__(self, index, n):
+        self._index = index
+        self._n = n
+
+    def __len__(self):
+        return self._n
+
+    def __contains__(self, uri):
+        return self.get(uri) is not None
+
+    def _record(self, i):
+        return TYPE.unpack_from(self._index._map, self._index._types_offset + TYPE.size * i)
+
+    def get(self, uri, default=None):
+        key = uri.encode("utf-8")
+        lo, hi = 0, self._n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            record = self._record(mid)
+            mid_key = self._index._bytes(record[0])
+            if mid_key < key:
+                lo = mid + 1
+            elif mid_key > key:
+                hi = mid
+            else:
+                return self._index._string(record[1]), self._index._string(record[2])
+        return default
+
+    def items(self):
+        """(object URI, (class URI, ConceptScheme URI)) tuples for all the objects, in order of URI"""
+        for i in range(self._n):
+            uri, cls, scheme = self._record(i)
+            yield self._index._string(uri), (self._index._string(cls), self._index._string(scheme))
@@ -6,10 +6,20 @@ from rdflib.namespace import DCTERMS, RDF, SKOS
 from vocprez.model.profiles import profile_skos
 import vocprez._config as config
 from typing import List
-from vocprez.model.property import Property
+from vocprez.model.property import Property, intern
 
 
 class Collection:
+    __slots__ = (
+        "vocab_uri",
+        "uri",
+        "prefLabel",
+        "definition",
+        "source",
+        "members",
+        "other_properties",
+    )
+
     def __init__(
         self,
         vocab_uri,
@@ -20,8 +30,8 @@ class Collection:
         members,
         other_properties: List[Property] = None
     ):
-        self.vocab_uri = vocab_uri
-        self.uri = uri
+        self.vocab_uri = intern(vocab_uri)
+        self.uri = intern(uri)
         self.prefLabel = prefLabel
         self.definition = definition
         self.source = source
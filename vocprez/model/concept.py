@@ -6,10 +6,21 @@ from rdflib.namespace import DCTERMS, RDF, RDFS, SKOS
 from vocprez.model.profiles import profile_skos
 import vocprez._config as config
 from typing import List
-from vocprez.model.property import Property
+from vocprez.model.property import Property, intern
 
 
 class Concept:
+    __slots__ = (
+        "vocab_uri",
+        "uri",
+        "prefLabel",
+        "definition",
+        "related_instances",
+        "annotations",
+        "agents",
+        "other_properties",
+    )
+
     def __init__(
         self,
         vocab_uri,
@@ -20,8 +31,8 @@ class Concept:
         annotations=None,
         other_properties: List[Property] = None
     ):
-        self.vocab_uri = vocab_uri
-        self.uri = uri
+        self.vocab_uri = intern(vocab_uri)
+        self.uri = intern(uri)
         self.prefLabel = prefLabel
         self.definition = definition
         self.related_instances = related_instances
@@ -30,6 +41,23 @@ class Concept:
 
         self.other_properties = other_properties
 
+    def to_dict(self):
+        """This Concept as a dict of JSON types, as given by the /concepts route"""
+        def properties(props):
+            return [
+                {"uri": p.uri, "label": p.label, "value": str(p.value), "value_label": p.value_label} for p in props
+            ]
+
+        return {
+            "uri": self.uri,
+            "vocab_uri": self.vocab_uri,
+            "prefLabel": self.prefLabel,
+            "definition": self.definition,
+            "related_instances": properties(p for props in (self.related_instances or {}).values() for p in props),
+            "annotations": properties(self.annotations or []),
+            "other_properties": properties(p for props in (self.other_properties or []) for p in props),
+        }
+
 
 class ConceptRenderer(Renderer):
     def __init__(self, request, concept):
@@ -1,9 +1,20 @@
+import sys
 from rdflib import URIRef, Literal
 
 
+def intern(s):
+    """
+    Interns a string, so that all the copies of a URI or label repeated across many objects share one string object.
+    Strings of subclasses of str, such as rdflib's URIRef and Literal, are returned as they are
+    """
+    return sys.intern(s) if type(s) is str else s
+
+
 class Property(object):
+    __slots__ = ("uri", "label", "value", "value_label")
+
     def __init__(self, uri: str, label: str, value: URIRef or Literal, value_label: str = None):
-        self.uri = uri
-        self.label = label
+        self.uri = intern(uri)
+        self.label = intern(label)
         self.value = value
         self.value_label = value_label
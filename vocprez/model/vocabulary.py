@@ -5,12 +5,37 @@ from rdflib import Graph, URIRef, Literal, XSD, RDF
 from rdflib.namespace import DCTERMS, OWL, SKOS, Namespace, NamespaceManager
 from vocprez.model.profiles import profile_skos, profile_dcat, profile_dd
 from typing import List
-from vocprez.model.property import Property
+from vocprez.model.property import Property, intern
 import json as j
 from vocprez._config import *
 
 
 class Vocabulary:
+    __slots__ = (
+        "id",
+        "uri",
+        "title",
+        "description",
+        "creator",
+        "created",
+        "modified",
+        "versionInfo",
+        "source",
+        "hasTopConcepts",
+        "hasTopConcept",  # set by the FILE source
+        "concepts",
+        "conceptHierarchy",
+        "concept_hierarchy",  # set by Sources' get_vocabulary()
+        "collections",
+        "accessURL",
+        "downloadURL",
+        "sparql_endpoint",
+        "collection_uris",
+        "sparql_username",
+        "sparql_password",
+        "other_properties",
+    )
+
     def __init__(
         self,
         id,
@@ -34,8 +59,8 @@ class Vocabulary:
         sparql_password=None,
         other_properties: List[Property] = None
     ):
-        self.id = id
-        self.uri = uri
+        self.id = intern(id)
+        self.uri = intern(uri)
         self.title = title
         self.description = description
         self.creator = creator
@@ -48,7 +73,7 @@ class Vocabulary:
         except:
             self.modified = modified
         self.versionInfo = versionInfo
-        self.source = source
+        self.source = intern(source)
         if hasTopConcept:
             hasTopConcept.sort()
         self.hasTopConcepts = hasTopConcept
@@ -57,7 +82,7 @@ class Vocabulary:
         self.collections = collections
         self.accessURL = accessURL
         self.downloadURL = downloadURL
-        self.sparql_endpoint = sparql_endpoint
+        self.sparql_endpoint = intern(sparql_endpoint)
         self.collection_uris = collection_uris
         self.sparql_username = sparql_username
         self.sparql_password = sparql_password
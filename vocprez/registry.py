@@ -0,0 +1,123 @@
+import threading
+import time
+import uuid
+import vocprez._config as config
+from .caching import LRUCache
+
+
+__all__ = [
+    "Registry",
+    "REGISTRY",
+]
+
+
+class Registry:
+    """
+    Process-level holder for the vocab index (the dict of Vocabulary objects keyed by vocab URI, usually a MappedVocabs
+    that makes each Vocabulary when first asked for it) and the parts of vocabs queried for since it was loaded.
+
+    The index is loaded once per process (e.g. once per gunicorn worker) and shared by all requests. It is never
+    mutated in place: a refresh builds a complete new dict and swaps it in with swap(), so a request that took a
+    reference to .vocabs keeps a consistent view for its whole lifetime.
+    """
+
+    def __init__(self):
+        # held only briefly, e.g. while swapping in a new index. Never wait for the cache file lock while holding it:
+        # the process holding that takes this lock to swap in the index it has built
+        self.lock = threading.RLock()
+        self._vocabs = None
+        self.generation = None
+        self.loaded_at = None
+        self.source_mtime = None
+        self.search_index = None
+        # URI -> (class URI, ConceptScheme URI) for all ConceptSchemes, Collections and Concepts
+        self.types = None
+        # set while a background refresh is running in this process
+        self.refreshing = False
+        # time.time() of the last background refresh that failed, so that the next waits for a while
+        self.refresh_failed_at = None
+        self.last_refresh_seconds = None
+        # the parts of vocabs that are queried for when first needed, such as their concept indexes, for the
+        # VOCAB_CACHE_MAX_ITEMS most recently used. See vocab_part()
+        self._vocab_parts = LRUCache(max_items=getattr(config, "VOCAB_CACHE_MAX_ITEMS", 200), sizeof=lambda part: 0)
+
+    @property
+    def vocabs(self):
+        return self._vocabs
+
+    def is_loaded(self):
+        return self._vocabs is not None
+
+    def changed_vocabs(self, vocabs):
+        """
+        The URIs of the vocabs in vocabs that are not in the current vocab index or may have changed since it was built,
+        going by their dcterms:modified dates. A vocab with no modified date can't be known to be unchanged, so it is
+        always counted as changed
+
+        :param vocabs: a new dict of Vocabulary objects, keyed by vocab URI
+        :rtype: set
+        """
+        previous = self._vocabs or {}
+        return {
+            uri for uri, vocab in vocabs.items()
+            if uri not in previous
+            or vocab.modified is None
+            or vocab.modified != previous[uri].modified
+            or vocab.sparql_endpoint != previous[uri].sparql_endpoint
+        }
+
+    def swap(self, vocabs, generation=None, source_mtime=None, search_index=None, types=None):
+        """
+        Atomically replace the current vocab index
+
+        :param vocabs: the new dict of Vocabulary objects, keyed by vocab URI
+        :param generation: an identifier for this build of the index, shared by all processes loading the same cache
+        file. A new one is made if not given
+        :param source_mtime: modification time of the cache file the index was loaded from, if any
+        :param search_index: the SearchIndex built along with the vocab index, if any
+        :param types: the map of object URIs to (class URI, ConceptScheme URI) built along with the vocab index, if any
+        """
+        with self.lock:
+            self._vocabs = vocabs
+            self.generation = generation or uuid.uuid4().hex
+            self.loaded_at = time.time()
+            self.source_mtime = source_mtime
+            self.search_index = search_index
+            self.types = types
+
+    def clear(self):
+        with self.lock:
+            self._vocabs = None
+            self.generation = None
+            self.loaded_at = None
+            self.source_mtime = None
+            self.search_index = None
+            self.types = None
+            self.refresh_failed_at = None
+            self._vocab_parts.clear()
+
+    def vocab_part(self, vocab_uri, part, language, build):
+        """
+        Returns a part of a vocab that is queried for when first needed, e.g. its concept index or concept hierarchy. It
+        is built by calling build() the first time it is asked for and then kept, while it is among the
+        VOCAB_CACHE_MAX_ITEMS parts most recently used, for as long as the vocab is unchanged: parts are kept per
+        dcterms:modified date of the vocab, or if it has none, per build of the vocab index.
+        """
+        vocab = self._vocabs.get(vocab_uri) if self._vocabs is not None else None
+        version = vocab.modified.isoformat() if vocab is not None and vocab.modified is not None else self.generation
+        key = (vocab_uri, version, part, language)
+        value = self._vocab_parts.get(key)
+        if value is None:
+            value = build()
+            self._vocab_parts.put(key, value)
+        return value
+
+    def concept_index(self, vocab_uri, language, build):
+        """
+        Returns the concept index of a vocab: a tuple of (uri, prefLabel, broader) tuples for all its Concepts, sorted
+        by prefLabel. See vocab_part()
+        """
+        return self.vocab_part(vocab_uri, "concepts", language, lambda: tuple(build()))
+
+
+REGISTRY = Registry()
@@ -0,0 +1,158 @@
+from array import array
+
+
+__all__ = [
+    "SearchIndex",
+]
+
+
+class SearchIndex:
+    """
+    In-process full-text index over Concepts' prefLabels, altLabels, hiddenLabels and definitions.
+
+    Matching is case-insensitive substring matching. Results are weighted as the original SPARQL search did: an exact
+    prefLabel match scores 50, plus 10 for a prefLabel containing the search term, 5 for each altLabel or hiddenLabel
+    and 1 for each definition containing it.
+
+    Every field's text is broken into trigrams and each trigram maps to the (sorted, compact) list of the Concepts whose
+    text contains it. A search only checks the Concepts listed for the search term's rarest trigram.
+    """
+
+    PREF_LABEL = 0
+    ALT_LABEL = 1
+    HIDDEN_LABEL = 2
+    DEFINITION = 3
+    WEIGHTS = {
+        ALT_LABEL: 5,
+        HIDDEN_LABEL: 5,
+        DEFINITION: 1,
+    }
+    EXACT_PREF_LABEL_WEIGHT = 50
+    PREF_LABEL_WEIGHT = 10
+
+    def __init__(self):
+        # per Concept: (graph, uri, ([prefLabel, ...], [altLabel, ...], [hiddenLabel, ...], [definition, ...]))
+        self._concepts = []
+        self._concept_ids = {}
+        self._trigrams = {}
+        self._finalised = True
+
+    def __len__(self):
+        return len(self._concepts)
+
+    def add(self, graph, uri, field, text):
+        """
+        Adds one label or definition of a Concept
+
+        :param graph: the named graph the Concept is in, which searches may be restricted to
+        :param uri: the Concept's URI
+        :param field: one of SearchIndex.PREF_LABEL, ALT_LABEL, HIDDEN_LABEL or DEFINITION
+        :param text: the label or definition
+        """
+        key = (graph, uri)
+        concept_id = self._concept_ids.get(key)
+        if concept_id is None:
+            concept_id = len(self._concepts)
+            self._concept_ids[key] = concept_id
+            self._concepts.append((graph, uri, ([], [], [], [])))
+        self._concepts[concept_id][2][field].append(text)
+
+        for trigram in self._text_trigrams(text.lower()):
+            postings = self._trigrams.get(trigram)
+            if postings is None:
+                self._trigrams[trigram] = array("I", [concept_id])
+            elif postings[-1] != concept_id:
+                if postings[-1] > concept_id:
+                    # fields added out of Concept order: sort postings lists before searching
+                    self._finalised = False
+                postings.append(concept_id)
+
+    def without_graphs(self, graphs):
+        """
+        A copy of this index without the Concepts in any of graphs, e.g. to add them again after they have changed
+
+        :param graphs: a set of named graphs
+        :rtype: SearchIndex
+        """
+        index = SearchIndex()
+        for graph, uri, fields in self._concepts:
+            if graph not in graphs:
+                for field, texts in enumerate(fields):
+                    for text in texts:
+                        index.add(graph, uri, field, text)
+        return index
+
+    def add_index(self, index, graphs=None):
+        """
+        Adds the Concepts of another index, or only those of them in any of graphs
+
+        :param index: a SearchIndex
+        :param graphs: a set of named graphs, or None for all of them
+        """
+        for graph, uri, fields in index._concepts:
+            if graphs is None or graph in graphs:
+                for field, texts in enumerate(fields):
+                    for text in texts:
+                        self.add(graph, uri, field, text)
+
+    def finalise(self):
+        """Sorts and de-duplicates postings lists. Must be called after adding fields out of Concept order"""
+        if not self._finalised:
+            for trigram, postings in self._trigrams.items():
+                self._trigrams[trigram] = array("I", sorted(set(postings)))
+            self._finalised = True
+
+    @staticmethod
+    def _text_trigrams(text):
+        return {text[i:i + 3] for i in range(len(text) - 2)}
+
+    def _candidates(self, term):
+        """IDs of the Concepts that may contain term"""
+        if len(term) < 3:
+            return range(len(self._concepts))
+
+        rarest = None
+        for trigram in self._text_trigrams(term):
+            postings = self._trigrams.get(trigram)
+            if postings is None:
+                return ()
+            if rarest is None or len(postings) < len(rarest):
+                rarest = postings
+        return rarest
+
+    def search(self, term, graph=None):
+        """
+        Finds the Concepts with a label or definition containing term
+
+        :param term: the search term
+        :param graph: if given, only Concepts in this named graph are searched
+        :return: a dict of lists of (uri, prefLabel) tuples, keyed by graph, in descending order of weight
+        :rtype: dict
+        """
+        self.finalise()
+        term = term.lower()
+
+        hits = []
+        for concept_id in self._candidates(term):
+            g, uri, fields = self._concepts[concept_id]
+            if graph is not None and g != graph:
+                continue
+
+            # altLabel, hiddenLabel & definition matches count towards every one of the Concept's prefLabels
+            weight = sum(
+                self.WEIGHTS[field] * sum(1 for text in fields[field] if term in text.lower())
+                for field in self.WEIGHTS
+            )
+            for pref_label in fields[self.PREF_LABEL]:
+                pl = pref_label.lower()
+                pref_label_weight = self.PREF_LABEL_WEIGHT if term in pl else 0
+                if pl == term:
+                    pref_label_weight += self.EXACT_PREF_LABEL_WEIGHT
+                if weight + pref_label_weight > 0:
+                    hits.append((weight + pref_label_weight, g, uri, pref_label))
+
+        hits.sort(key=lambda hit: (-hit[0], hit[3]))
+        results = {}
+        for weight, g, uri, pref_label in hits:
+            results.setdefault(g, []).append((uri, pref_label))
+        return results
@@ -1,6 +1,12 @@
-from flask import g
+import copy
+import logging
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from flask import g, current_app, has_app_context
 from ..utils import *
 from ..utils import suppressed_properties
+from ..registry import REGISTRY
 from ..model.property import Property
 import vocprez._config as config
 
@@ -10,6 +16,31 @@ __all__ = [
 ]
 
 
+# bounded pool, shared by all requests in a process, for running a page's independent SPARQL queries concurrently
+_QUERY_POOL = ThreadPoolExecutor(
+    max_workers=getattr(config, "SPARQL_QUERY_THREADS", 8),
+    thread_name_prefix="vocprez-query"
+)
+
+
+def _in_app_context(method):
+    """
+    Wraps a method to be run in another thread in an app context of its own with the current request's vocab index,
+    if there is a current request
+    """
+    if not has_app_context():
+        return method
+
+    app = current_app._get_current_object()
+    vocabs = g.VOCABS
+
+    def run(*args):
+        with app.app_context():
+            g.VOCABS = vocabs
+            return method(*args)
+    return run
+
+
 class Source:
     VOC_TYPES = [
         "http://www.w3.org/2004/02/skos/core#ConceptScheme",
@@ -23,9 +54,17 @@ class Source:
 
     @property
     def graph(self):
-        # no graph cache file so extract graph from source and cache
         vocab = g.VOCABS[self.vocab_uri]
 
+        # graphs are cached per vocab and per dcterms:modified date, or if there is none, per build of the vocab index,
+        # so a refreshed index never gets stale graphs but keeps those of unchanged vocabs
+        cache_key = "{}|{}".format(
+            vocab.uri, vocab.modified.isoformat() if vocab.modified is not None else REGISTRY.generation)
+        self._graph = GRAPH_CACHE.get(cache_key)
+        if self._graph is not None:
+            return self._graph
+
+        # no cached graph so extract graph from source and cache
         q = """
                 PREFIX skos: <http://www.w3.org/2004/02/skos/core#>
                 PREFIX rdfs: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
@@ -84,7 +123,7 @@ class Source:
             sparql_username=vocab.sparql_username,
             sparql_password=vocab.sparql_password,
         )
-        cache_write(self._graph)
+        GRAPH_CACHE.put(cache_key, self._graph)
         return self._graph
 
     @staticmethod
@@ -92,6 +131,28 @@ class Source:
         """
         Specialised Sources must implement a collect method to get all the vocabs of their sort, listed in
         _config/__init__.py, at startup
+
+        :return: a dict of Vocabulary objects, keyed by vocab URI
+        """
+        return {}
+
+    @staticmethod
+    def collect_types(details, types, vocab_uris=None):
+        """
+        Specialised Sources may implement a collect_types method to add the URIs of all their ConceptSchemes,
+        Collections and Concepts to the types dict, mapped to (class URI, ConceptScheme URI) tuples
+
+        :param vocab_uris: if given, only the objects in the named graphs of these vocabs are added
+        """
+        pass
+
+    @staticmethod
+    def collect_search_index(details, search_index, vocab_uris=None):
+        """
+        Specialised Sources may implement a collect_search_index method to add the labels and definitions of all their
+        Concepts to the SearchIndex used by /search
+
+        :param vocab_uris: if given, only the Concepts in the named graphs of these vocabs are added
         """
         pass
 
@@ -137,25 +198,65 @@ class Source:
             ORDER BY ?pl
             """.format(vocab_uri=vocab.uri, language=self.language)
 
-        return [
-            (
-                concept["c"]["value"],
-                concept["pl"]["value"],
-                concept["broader"]["value"] if concept.get("broader") else None
+        return list(iter_sparql_rows(
+            q, ("c", "pl", "broader"), vocab.sparql_endpoint, vocab.sparql_username, vocab.sparql_password
+        ))
+
+    def get_concept_index(self, vocab_uri):
+        """
+        All of a vocab's Concepts as (uri, prefLabel, broader) tuples, sorted by prefLabel. This is queried for once
+        per vocab, language and version and then served from memory. See Registry.vocab_part()
+        """
+        return REGISTRY.concept_index(
+            vocab_uri,
+            self.language,
+            lambda: (
+                (sys.intern(c[0]), c[1], sys.intern(c[2]) if c[2] is not None else None)
+                for c in self.list_concepts(vocab_uri)
             )
-            for concept in sparql_query(q, vocab.sparql_endpoint, vocab.sparql_username, vocab.sparql_password)
-        ]
+        )
+
+    def get_cached_concept_hierarchy(self, vocab_uri):
+        """A vocab's drawn concept hierarchy, queried for once per vocab, language & version. See vocab_part()"""
+        return REGISTRY.vocab_part(
+            vocab_uri, "concept_hierarchy", self.language, lambda: self.get_concept_hierarchy(vocab_uri))
+
+    def get_cached_collections(self, vocab_uri):
+        """A vocab's Collections, queried for once per vocab, language and version. See Registry.vocab_part()"""
+        return REGISTRY.vocab_part(
+            vocab_uri, "collections", self.language, lambda: self.list_collections(vocab_uri))
 
     def get_vocabulary(self, vocab_uri):
         """
-        Get a vocab from the cache
+        Get a vocab from the cache, with its concept hierarchy, concepts and collections.
+
+        These three are independent queries so they are run concurrently, making the time taken that of the slowest
+        rather than the sum of all three. A query that fails or takes longer than SPARQL_TIMEOUT is logged and its part
+        of the vocab left as None rather than failing the whole vocab, and the response is marked as partial so that it
+        isn't cached.
         :return:
         :rtype:
         """
-        vocab = g.VOCABS[vocab_uri]
-        vocab.concept_hierarchy = self.get_concept_hierarchy(vocab_uri)
-        vocab.concepts = self.list_concepts(vocab_uri)
-        vocab.collections = self.list_collections(vocab_uri)
+        # a copy, so that the vocab shared by all requests via the registry isn't changed
+        vocab = copy.copy(g.VOCABS[vocab_uri])
+
+        futures = {
+            "concept_hierarchy": _QUERY_POOL.submit(_in_app_context(self.get_cached_concept_hierarchy), vocab_uri),
+            "concepts": _QUERY_POOL.submit(_in_app_context(self.get_concept_index), vocab_uri),
+            "collections": _QUERY_POOL.submit(_in_app_context(self.get_cached_collections), vocab_uri),
+        }
+        deadline = time.time() + config.SPARQL_TIMEOUT
+        for attribute, future in futures.items():
+            try:
+                setattr(vocab, attribute, future.result(timeout=max(deadline - time.time(), 0)))
+            except TimeoutError:
+                logging.error("Timed out getting the {} of vocab {}".format(attribute, vocab_uri))
+                setattr(vocab, attribute, None)
+                mark_response_partial()
+            except Exception as e:
+                logging.error("Unable to get the {} of vocab {}: {}".format(attribute, vocab_uri, e))
+                setattr(vocab, attribute, None)
+                mark_response_partial()
         return vocab
 
     def get_collection(self, collection_uri):
@@ -234,33 +335,67 @@ class Source:
         return Collection(vocab_uri, collection_uri, pl, d, s, sorted(m, key=lambda x: x.value_label.lower()))
 
     def get_concept(self, vocab_uri, uri):
+        return self.get_concepts(vocab_uri, [uri]).get(uri)
+
+    def get_concepts(self, vocab_uri, uris):
+        """
+        Gets several of a vocab's Concepts, with their properties and the labels of those properties and their values,
+        in one query per GET_CONCEPTS_BATCH_SIZE Concepts, whose URIs are given to the endpoint in a VALUES block
+
+        :param vocab_uri: the URI of the vocab the Concepts are in
+        :param uris: the Concepts' URIs
+        :return: a dict of Concept objects, keyed by URI, of those of uris that are Concepts, leaving out any that aren't
+        IRIs
+        :rtype: dict
+        """
         vocab = g.VOCABS[vocab_uri]
-        q = """
-            PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
-            PREFIX skos: <http://www.w3.org/2004/02/skos/core#>
+        # anything that isn't an IRI would break the whole query it was put in
+        uris = [uri for uri in dict.fromkeys(uris) if is_iri(uri)]
+        batch_size = getattr(config, "GET_CONCEPTS_BATCH_SIZE", 100)
+
+        rows = {}
+        for batch in range(0, len(uris), batch_size):
+            q = """
+                PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
+                PREFIX skos: <http://www.w3.org/2004/02/skos/core#>
+
+                SELECT DISTINCT ?c ?p ?o ?ppl ?opl
+                WHERE {{
+                    VALUES ?c {{ {uris} }}
+                    ?c a skos:Concept ;
+                       ?p ?o .
 
-            SELECT DISTINCT *            
-            WHERE {
-            
-                    <xxxx> a skos:Concept ;
-                           ?p ?o .
-    
                     FILTER(!isLiteral(?o) || lang(?o) = "en" || lang(?o) = "")
-    
-                    
-                
-                OPTIONAL {
+
+                    OPTIONAL {{
                         ?p skos:prefLabel|rdfs:label ?ppl .
                         FILTER(!isLiteral(?ppl) || lang(?ppl) = "en" || lang(?ppl) = "")
-                    }
-                    
-                    OPTIONAL {
+                    }}
+
+                    OPTIONAL {{
                         ?o skos:prefLabel|rdfs:label ?opl .
                         FILTER(!isLiteral(?opl) || lang(?opl) = "en" || lang(?opl) = "")
-                    }
-            }
-            """.replace("xxxx", uri)
+                    }}
+                }}
+                """.format(uris=" ".join("<{}>".format(uri) for uri in uris[batch:batch + batch_size]))
+
+            for c, prop, val, property_label, object_label in iter_sparql_rows(
+                    q,
+                    ("c", "p", "o", "ppl", "opl"),
+                    vocab.sparql_endpoint,
+                    vocab.sparql_username,
+                    vocab.sparql_password):
+                rows.setdefault(c, []).append((prop, val, property_label, object_label))
 
+        return {uri: self._make_concept(vocab_uri, uri, rows[uri]) for uri in uris if uri in rows}
+
+    @staticmethod
+    def _make_concept(vocab_uri, uri, rows):
+        """
+        Makes a Concept from the rows of a get_concepts() query for it
+
+        :param rows: (property, value, property label, value label) tuples
+        """
         pl = None
         d = None
         c = None
@@ -354,18 +489,7 @@ class Source:
             "http://www.w3.org/2000/01/rdf-schema#isDefinedBy": "Is Defined By",
         }
         other_properties = {}
-        found = False
-        for r in sparql_query(q, vocab.sparql_endpoint, vocab.sparql_username, vocab.sparql_password):
-            prop = r["p"]["value"]
-            val = r["o"]["value"]
-            property_label = None
-            if r.get("ppl") is not None:
-                property_label = r["ppl"]["value"]
-            object_label = None
-            if r.get("opl") is not None:
-                object_label = r["opl"]["value"]
-
-            found = True
+        for prop, val, property_label, object_label in rows:
             if val == "http://www.w3.org/2004/02/skos/core#Concept":
                 pass
             elif prop == "http://www.w3.org/2004/02/skos/core#prefLabel":
@@ -406,9 +530,6 @@ class Source:
                             other_properties[prop] = []
                         other_properties.setdefault(prop, []).append((Property(prop, property_label, val, object_label)))
 
-        if not found:
-            return None
-
         from vocprez.model.concept import Concept
 
         if not d:
@@ -428,46 +549,6 @@ class Source:
         Function to draw concept hierarchy for vocabulary
         """
 
-        def build_hierarchy(bindings_list, broader_concept=None, level=0):
-            """
-            Recursive helper function to build hierarchy list from a bindings list
-            Returns list of tuples: (<level>, <concept>, <concept_preflabel>, <broader_concept>)
-            """
-            level += 1  # Start with level 1 for top concepts
-            hier = []
-
-            narrower_list = sorted(
-                [
-                    binding_dict
-                    for binding_dict in bindings_list
-                    if (  # Top concept
-                               (broader_concept is None)
-                               and (binding_dict.get("broader_concept") is None)
-                       )
-                       or  # Narrower concept
-                       (
-                               (binding_dict.get("broader_concept") is not None)
-                               and (
-                                       binding_dict["broader_concept"]["value"] == broader_concept
-                               )
-                       )
-                ],
-                key=lambda binding_dict: binding_dict["concept_preflabel"]["value"],
-            )
-            for binding_dict in narrower_list:
-                concept = binding_dict["concept"]["value"]
-                hier += [
-                                 (
-                                     level,
-                                     concept,
-                                     binding_dict["concept_preflabel"]["value"],
-                                     binding_dict["broader_concept"]["value"]
-                                     if binding_dict.get("broader_concept")
-                                     else None,
-                                 )
-                             ] + build_hierarchy(bindings_list, concept, level)
-            return hier
-
         vocab = g.VOCABS[vocab_uri]
 
         query = """
@@ -500,11 +581,14 @@ class Source:
                 language=self.language
             )
 
-        bindings_list = sparql_query(query, vocab.sparql_endpoint, vocab.sparql_username, vocab.sparql_password)
-
-        assert bindings_list is not None, "SPARQL concept hierarchy query failed"
-
-        hierarchy = build_hierarchy(bindings_list)
+        # results are parsed as they arrive, so only the hierarchy is ever held in memory, not the query's results
+        hierarchy = build_concept_hierarchy(iter_sparql_rows(
+            query,
+            ("concept", "concept_preflabel", "broader_concept"),
+            vocab.sparql_endpoint,
+            vocab.sparql_username,
+            vocab.sparql_password,
+        ))
 
         return draw_concept_hierarchy(hierarchy)
 
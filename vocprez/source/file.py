@@ -112,9 +112,8 @@ class File(Source):
                             str(cs[5]) if cs[5] is not None else None,  # versionInfo
                             config.VocabSource.File,
                         )
-        g.VOCABS = {**g.VOCABS, **file_vocabs}
-
         logging.debug("FILE collect() complete.")
+        return file_vocabs
         # # Get register item metadata
         # for vocab_id in g.VOCABS:
         #     if vocab_id in g.VOCABS:
@@ -468,49 +467,6 @@ class File(Source):
         Function to draw concept hierarchy for vocabulary
         """
 
-        def build_hierarchy(bindings_list, broader_concept=None, level=0):
-            """
-            Recursive helper function to build hierarchy list from a bindings list
-            Returns list of tuples: (<level>, <concept>, <concept_preflabel>, <broader_concept>)
-            """
-            level += 1  # Start with level 1 for top concepts
-            hierarchy = []
-
-            narrower_list = sorted(
-                [
-                    binding_dict
-                    for binding_dict in bindings_list
-                    if
-                    # Top concept
-                    (
-                        (broader_concept is None)
-                        and (binding_dict.get("broader_concept") is None)
-                    )
-                    or
-                    # Narrower concept
-                    (
-                        (binding_dict.get("broader_concept") is not None)
-                        and (binding_dict["broader_concept"] == broader_concept)
-                    )
-                ],
-                key=lambda binding_dict: binding_dict["concept_preflabel"],
-            )
-
-            for binding_dict in narrower_list:
-                concept = binding_dict["concept"]
-                hierarchy += [
-                    (
-                        level,
-                        concept,
-                        binding_dict["concept_preflabel"],
-                        binding_dict["broader_concept"]
-                        if binding_dict.get("broader_concept")
-                        else None,
-                    )
-                ] + build_hierarchy(bindings_list, concept, level)
-
-            return hierarchy
-
         vocab = g.VOCABS[self.vocab_id]
 
         q = """
@@ -534,22 +490,12 @@ class File(Source):
             vocab_uri=vocab.uri, language=self.language
         )
 
-        bindings_list = []
-        for r in self.gr.query(q):
-            bindings_list.append(
-                {
-                    # ?concept ?concept_preflabel ?broader_concept
-                    "concept": r[0],
-                    "concept_preflabel": r[1],
-                    "broader_concept": r[2],
-                }
-            )
-
-        assert bindings_list is not None, "FILE concept hierarchy query failed"
-
-        hierarchy = build_hierarchy(bindings_list)
+        # ?concept ?concept_preflabel ?broader_concept
+        hierarchy = vocprez.utils.build_concept_hierarchy(
+            (r[0], r[1], r[2]) for r in self.gr.query(q)
+        )
 
-        return vocprez.source.utils.draw_concept_hierarchy(hierarchy)
+        return vocprez.utils.draw_concept_hierarchy(hierarchy)
 
     def get_object_class(self):
         uri = vocprez.app.url_decode(self.request.values.get("uri"))
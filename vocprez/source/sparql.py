@@ -1,9 +1,10 @@
 import logging
+import sys
 import dateutil.parser
-from flask import g
 import vocprez.utils as u
 from vocprez import _config as config
 from vocprez.model.vocabulary import Vocabulary
+from vocprez.search import SearchIndex
 from vocprez.source._source import *
 from markdown import markdown
 
@@ -29,8 +30,54 @@ class SPARQL(Source):
         """
         logging.debug("SPARQL collect()...")
 
-        # Get all the ConceptSchemes from the SPARQL endpoint
+        # Get all the ConceptSchemes from the SPARQL endpoint, a page at a time
         # Interpret each CS as a Vocab
+        page_size = details.get("collect_page_size", getattr(config, "COLLECT_PAGE_SIZE", 500))
+        sparql_vocabs = {}
+        vocab_ids = []
+        last = None
+        while True:
+            page = SPARQL._concept_scheme_page(details, last, page_size)
+            if len(page) > 0:
+                SPARQL._collect_page(details, page, sparql_vocabs, vocab_ids)
+            if len(page) < page_size:
+                break
+            last = page[-1]
+
+        logging.debug("SPARQL collect() complete.")
+        return dict(sorted(sparql_vocabs.items(), key=lambda item: item[1].title))
+
+    @staticmethod
+    def _concept_scheme_page(details, after, page_size):
+        """
+        The URIs of up to page_size ConceptSchemes, in order of URI, starting after the URI after. Pages are found by the
+        last URI of the previous one rather than an OFFSET so that the endpoint doesn't re-scan the earlier pages
+        """
+        q = """
+            PREFIX skos: <http://www.w3.org/2004/02/skos/core#>
+            SELECT DISTINCT ?cs
+            WHERE {{
+                ?cs a skos:ConceptScheme .
+                FILTER(isIRI(?cs){after})
+            }}
+            ORDER BY STR(?cs)
+            LIMIT {page_size}
+            """.format(
+            after=' && STR(?cs) > "{}"'.format(after.replace("\\", "\\\\").replace('"', '\\"')) if after else "",
+            page_size=page_size,
+        )
+        concept_schemes = u.sparql_query(
+            q,
+            details["sparql_endpoint"],  # must specify a SPARQL endpoint if this source is to be a SPARQL source
+            details.get("sparql_username"),
+            details.get("sparql_password"),
+        )
+        assert concept_schemes is not None, "Unable to query for ConceptSchemes"
+        return [cs["cs"]["value"] for cs in concept_schemes]
+
+    @staticmethod
+    def _collect_page(details, page, sparql_vocabs, vocab_ids):
+        """Adds a Vocabulary to sparql_vocabs for each of the ConceptSchemes in page, a list of their URIs"""
         q = """
             PREFIX skos: <http://www.w3.org/2004/02/skos/core#>
             PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
@@ -39,7 +86,7 @@ class SPARQL(Source):
             PREFIX foaf: <http://xmlns.com/foaf/0.1/>
             SELECT DISTINCT * 
             WHERE {{
-                
+                    VALUES ?cs {{ {concept_schemes} }}
                     ?cs a skos:ConceptScheme .
                     OPTIONAL {{ ?cs skos:prefLabel ?title .
                         FILTER(lang(?title) = "{language}" || lang(?title) = "") }}
@@ -61,22 +108,24 @@ class SPARQL(Source):
                         FILTER(lang(?comment) = "{language}" || lang(?comment) = "") }}
                     BIND( COALESCE(?dcdescription, ?skosdef, ?comment, "Set dcterms:description or skos:definition to describe this vocabulary") AS ?description )
                 
-            }} 
-            ORDER BY ?title
-            """.format(language=config.DEFAULT_LANGUAGE)
+            }}
+            """.format(
+            concept_schemes=" ".join("<{}>".format(cs) for cs in page),
+            language=config.DEFAULT_LANGUAGE,
+        )
         # record just the IDs & title for the VocPrez in-memory vocabs list
-        concept_schemes = u.sparql_query(
+        concept_schemes = u.iter_sparql_query(
             q,
-            details["sparql_endpoint"],  # must specify a SPARQL endpoint if this source is to be a SPARQL source
+            details["sparql_endpoint"],
             details.get("sparql_username"),
             details.get("sparql_password"),
         )
-        assert concept_schemes is not None, "Unable to query for ConceptSchemes"
 
-        sparql_vocabs = {}
-        vocab_ids = []
         for cs in concept_schemes:
             vocab_id = cs["cs"]["value"]
+            # a ConceptScheme with several values of a property has a row for each: the first is used
+            if vocab_id in sparql_vocabs:
+                continue
             part = cs["cs"]["value"].split("#")[-1].split("/")[-1]
             if len(part) < 1:
                 part = cs["cs"]["value"].split("#")[-1].split("/")[-2]
@@ -89,7 +138,6 @@ class SPARQL(Source):
 
             vocab_ids.append(id)
 
-
             sparql_vocabs[vocab_id] = Vocabulary(
                 id,
                 cs["cs"]["value"],
@@ -106,5 +154,78 @@ class SPARQL(Source):
                 sparql_username=details.get("sparql_username"),
                 sparql_password=details.get("sparql_password"),
             )
-        g.VOCABS = {**g.VOCABS, **sparql_vocabs}
-        logging.debug("SPARQL collect() complete.")
+
+    @staticmethod
+    def collect_types(details, types, vocab_uris=None):
+        logging.debug("SPARQL collect_types()...")
+
+        q = """
+            PREFIX skos: <http://www.w3.org/2004/02/skos/core#>
+            SELECT DISTINCT ?s ?c ?cs
+            WHERE {{
+                {graphs}
+                GRAPH ?g {{
+                    VALUES ?c {{ skos:ConceptScheme skos:Collection skos:Concept }}
+                    ?s a ?c .
+                    OPTIONAL {{
+                        VALUES ?memberof {{ skos:inScheme skos:topConceptOf }}
+                        ?s ?memberof ?cs .
+                    }}
+                }}
+            }}
+            """.format(graphs=SPARQL._graphs_values(vocab_uris))
+        objects = u.iter_sparql_rows(
+            q,
+            ("s", "c", "cs"),
+            details["sparql_endpoint"],
+            details.get("sparql_username"),
+            details.get("sparql_password"),
+        )
+
+        for uri, cls, cs in objects:
+            # an object's first class & ConceptScheme found is the one used, as for an /object query
+            if uri not in types:
+                types[sys.intern(uri)] = (sys.intern(cls), sys.intern(cs) if cs is not None else None)
+        logging.debug("SPARQL collect_types() complete.")
+
+    @staticmethod
+    def collect_search_index(details, search_index, vocab_uris=None):
+        logging.debug("SPARQL collect_search_index()...")
+
+        q = """
+            PREFIX skos: <http://www.w3.org/2004/02/skos/core#>
+            SELECT ?g ?uri ?p ?o
+            WHERE {{
+                {graphs}
+                GRAPH ?g {{
+                    VALUES ?p {{ skos:prefLabel skos:altLabel skos:hiddenLabel skos:definition }}
+                    ?uri a skos:Concept ;
+                         ?p ?o .
+                }}
+            }}
+            """.format(graphs=SPARQL._graphs_values(vocab_uris))
+        # labels are added to the index as they are parsed, so the query's results are never all in memory at once
+        labels = u.iter_sparql_rows(
+            q,
+            ("g", "uri", "p", "o"),
+            details["sparql_endpoint"],
+            details.get("sparql_username"),
+            details.get("sparql_password"),
+        )
+
+        fields = {
+            "http://www.w3.org/2004/02/skos/core#prefLabel": SearchIndex.PREF_LABEL,
+            "http://www.w3.org/2004/02/skos/core#altLabel": SearchIndex.ALT_LABEL,
+            "http://www.w3.org/2004/02/skos/core#hiddenLabel": SearchIndex.HIDDEN_LABEL,
+            "http://www.w3.org/2004/02/skos/core#definition": SearchIndex.DEFINITION,
+        }
+        for graph, uri, p, o in labels:
+            search_index.add(graph, uri, fields[p], o)
+        logging.debug("SPARQL collect_search_index() complete.")
+
+    @staticmethod
+    def _graphs_values(vocab_uris):
+        """A VALUES block restricting ?g to the named graphs of vocab_uris, or nothing if they are not given"""
+        if vocab_uris is None:
+            return ""
+        return "VALUES ?g {{ {} }}".format(" ".join("<{}>".format(uri) for uri in sorted(vocab_uris)))
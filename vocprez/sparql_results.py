@@ -0,0 +1,270 @@
+import codecs
+import csv
+import json
+import re
+import xml.etree.ElementTree as ET
+
+
+__all__ = [
+    "iter_bindings",
+    "iter_csv_bindings",
+    "iter_json_bindings",
+    "iter_rows",
+    "iter_tsv_bindings",
+    "iter_tsv_rows",
+    "iter_xml_bindings",
+]
+
+
+# Iterators over the results of SPARQL SELECT queries, which parse each result as the bytes of the response arrive and
+# yield it as a dict of bindings keyed by variable name, in the form of the SPARQL JSON results format, e.g.
+#
+#   {"c": {"type": "uri", "value": "http://example.com/c"}, "pl": {"type": "literal", "value": "C", "xml:lang": "en"}}
+#
+# Variables unbound in a result are left out of its dict. Only one result (or, for JSON, one chunk of the response) is
+# held in memory at a time, however many there are.
+
+_JSON_BINDINGS = re.compile(r'"bindings"\s*:\s*\[')
+_JSON_SEPARATOR = re.compile(r"[\s,]*")
+_XML_NS = "{http://www.w3.org/2005/sparql-results#}"
+_XML_LANG = "{http://www.w3.org/XML/1998/namespace}lang"
+_XSD = "http://www.w3.org/2001/XMLSchema#"
+_TSV_LITERAL = re.compile(r'"((?:[^"\\]|\\.)*)"(?:@([A-Za-z0-9-]+)|\^\^<([^>]*)>)?$', re.DOTALL)
+_TSV_ESCAPE = re.compile(r"\\(u[0-9A-Fa-f]{4}|U[0-9A-Fa-f]{8}|.)", re.DOTALL)
+_TSV_ESCAPES = {"t": "\t", "b": "\b", "n": "\n", "r": "\r", "f": "\f", '"': '"', "'": "'", "\\": "\\"}
+
+
+def _text(chunks):
+    """Decodes an iterable of UTF-8 bytes chunks, which may split characters, to str chunks"""
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    for chunk in chunks:
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+    text = decoder.decode(b"", final=True)
+    if text:
+        yield text
+
+
+def _lines(chunks, keepends=False):
+    """Splits an iterable of UTF-8 bytes chunks into lines"""
+    remainder = ""
+    for text in _text(chunks):
+        lines = (remainder + text).split("\n")
+        remainder = lines.pop()
+        for line in lines:
+            yield line + "\n" if keepends else line.rstrip("\r")
+    if remainder:
+        yield remainder if keepends else remainder.rstrip("\r")
+
+
+def iter_json_bindings(chunks):
+    """
+    Results of a query in the SPARQL JSON results format (application/sparql-results+json)
+
+    :param chunks: an iterable of bytes, e.g. a requests Response's iter_content()
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = None  # of the next result in buffer, once the bindings array has been found
+    for text in _text(chunks):
+        buffer += text
+        if position is None:
+            found = _JSON_BINDINGS.search(buffer)
+            if found is None:
+                continue
+            position = found.end()
+
+        while True:
+            position = _JSON_SEPARATOR.match(buffer, position).end()
+            if position == len(buffer) or buffer[position] == "]":
+                break
+            try:
+                result, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                break  # the rest of this result has yet to arrive
+            yield result
+        buffer = buffer[position:]
+        position = 0
+
+        if buffer.startswith("]"):
+            return
+
+    if position is not None and buffer.strip():
+        raise ValueError("SPARQL JSON results ended part way through a result")
+
+
+def iter_xml_bindings(chunks):
+    """
+    Results of a query in the SPARQL XML results format (application/sparql-results+xml)
+
+    :param chunks: an iterable of bytes, e.g. a requests Response's iter_content()
+    """
+    parser = ET.XMLPullParser(events=("end",))
+    for chunk in chunks:
+        parser.feed(chunk)
+        yield from _xml_results(parser)
+    parser.close()
+    yield from _xml_results(parser)
+
+
+def _xml_results(parser):
+    for event, element in parser.read_events():
+        if element.tag != _XML_NS + "result":
+            continue
+        result = {}
+        for binding in element:
+            for value in binding:
+                term = {"type": value.tag[len(_XML_NS):], "value": value.text or ""}
+                if value.get(_XML_LANG) is not None:
+                    term["xml:lang"] = value.get(_XML_LANG)
+                if value.get("datatype") is not None:
+                    term["datatype"] = value.get("datatype")
+                result[binding.get("name")] = term
+        # results already yielded are dropped so the document is never held in memory as a whole
+        element.clear()
+        yield result
+
+
+def _tsv_term(value):
+    """A term in the SPARQL TSV results format, which is that of Turtle, as a SPARQL JSON results format term"""
+    if value.startswith("<") and value.endswith(">"):
+        return {"type": "uri", "value": value[1:-1]}
+    if value.startswith("_:"):
+        return {"type": "bnode", "value": value[2:]}
+    literal = _TSV_LITERAL.match(value)
+    if literal is not None:
+        text, language, datatype = literal.groups()
+        if "\\" in text:
+            text = _TSV_ESCAPE.sub(_tsv_unescape, text)
+        term = {"type": "literal", "value": text}
+        if language is not None:
+            term["xml:lang"] = language
+        if datatype is not None:
+            term["datatype"] = datatype
+        return term
+
+    # unquoted numbers & booleans
+    if value in ("true", "false"):
+        datatype = "boolean"
+    elif re.match(r"[+-]?\d+$", value):
+        datatype = "integer"
+    elif re.match(r"[+-]?\d*\.\d+$", value):
+        datatype = "decimal"
+    else:
+        datatype = "double"
+    return {"type": "literal", "value": value, "datatype": _XSD + datatype}
+
+
+def _tsv_unescape(match):
+    escape = match.group(1)
+    if escape[0] in "uU" and len(escape) > 1:
+        return chr(int(escape[1:], 16))
+    return _TSV_ESCAPES.get(escape, "\\" + escape)
+
+
+def iter_tsv_bindings(chunks):
+    """
+    Results of a query in the SPARQL TSV results format (text/tab-separated-values)
+
+    :param chunks: an iterable of bytes, e.g. a requests Response's iter_content()
+    """
+    lines = _lines(chunks)
+    header = next(lines, None)
+    if header is None:
+        return
+    variables = [v.lstrip("?$") for v in header.split("\t")]
+    for line in lines:
+        result = {}
+        for variable, value in zip(variables, line.split("\t")):
+            if value:
+                result[variable] = _tsv_term(value)
+        yield result
+
+
+def _tsv_value(value):
+    """The value of a term in the SPARQL TSV results format, without its type, language or datatype"""
+    if not value:
+        return None
+    first = value[0]
+    if first == "<":
+        return value[1:-1]
+    if first == '"':
+        text = value[1:value.rindex('"')]
+        return _TSV_ESCAPE.sub(_tsv_unescape, text) if "\\" in text else text
+    if first == "_" and value.startswith("_:"):
+        return value[2:]
+    return value
+
+
+def iter_tsv_rows(chunks, variables):
+    """
+    The values of variables in each of the results of a query in the SPARQL TSV results format, as tuples, with None for
+    variables unbound in a result. This skips making the dicts of iter_tsv_bindings(), for loops that only need values
+
+    :param chunks: an iterable of bytes, e.g. a requests Response's iter_content()
+    :param variables: a sequence of variable names, without "?"
+    """
+    lines = _lines(chunks)
+    header = next(lines, None)
+    if header is None:
+        return
+    columns = [v.lstrip("?$") for v in header.split("\t")]
+    if columns == list(variables):
+        for line in lines:
+            yield tuple(map(_tsv_value, line.split("\t")))
+        return
+
+    indexes = [columns.index(v) if v in columns else None for v in variables]
+    for line in lines:
+        values = line.split("\t")
+        yield tuple(_tsv_value(values[i]) if i is not None and i < len(values) else None for i in indexes)
+
+
+def iter_csv_bindings(chunks):
+    """
+    Results of a query in the SPARQL CSV results format (text/csv). The format doesn't say whether a value is a URI or a
+    literal, nor give literals' languages or datatypes, so every value is given as a plain literal, and empty values
+    are taken to be unbound
+
+    :param chunks: an iterable of bytes, e.g. a requests Response's iter_content()
+    """
+    rows = csv.reader(_lines(chunks, keepends=True))
+    variables = next(rows, None)
+    if variables is None:
+        return
+    for row in rows:
+        yield {variable: {"type": "literal", "value": value} for variable, value in zip(variables, row) if value}
+
+
+def iter_bindings(chunks, content_type):
+    """
+    Results of a query in whichever of the SPARQL JSON, XML, TSV or CSV results formats content_type says
+
+    :param chunks: an iterable of bytes, e.g. a requests Response's iter_content()
+    :param content_type: the response's Content-Type header
+    """
+    if "tab-separated-values" in content_type:
+        return iter_tsv_bindings(chunks)
+    if "csv" in content_type:
+        return iter_csv_bindings(chunks)
+    if "xml" in content_type:
+        return iter_xml_bindings(chunks)
+    return iter_json_bindings(chunks)
+
+
+def iter_rows(chunks, content_type, variables):
+    """
+    The values of variables in each of the results of a query, as tuples, with None for variables unbound in a result.
+    TSV results are decoded straight to tuples; results in any other format are made from their bindings
+
+    :param chunks: an iterable of bytes, e.g. a requests Response's iter_content()
+    :param content_type: the response's Content-Type header
+    :param variables: a sequence of variable names, without "?"
+    """
+    if "tab-separated-values" in content_type:
+        return iter_tsv_rows(chunks, variables)
+    return (
+        tuple(result[v]["value"] if v in result else None for v in variables)
+        for result in iter_bindings(chunks, content_type)
+    )
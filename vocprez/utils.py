@@ -1,149 +1,921 @@
-import base64
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from contextlib import contextmanager
+import datetime
+import hashlib
 import logging
 import os
 import pickle
+import threading
 import time
+import uuid
+import zlib
 import markdown
 import requests
-from SPARQLWrapper import SPARQLWrapper, JSON, BASIC
-from flask import g
+import requests.adapters
+from flask import g, has_app_context, Response
 from rdflib import Graph, SKOS, URIRef
-from xml.dom.minidom import Document as xml_Document
 import urllib
 import re
-from bs4 import BeautifulSoup
+from markupsafe import escape
 import vocprez._config as config
 from . import source
+from .admission import SlotLimiter
+from .caching import DiskCache, LRUCache
+from .index import IndexFormatError, MappedIndex, write_index
+from .registry import REGISTRY
+from .search import SearchIndex
+from .sparql_results import iter_bindings, iter_rows
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows, where cache rebuilds are not coordinated between processes
+    fcntl = None
 
 
 __all__ = [
+    "GRAPH_CACHE",
+    "RESPONSE_CACHE",
+    "SPARQL_PROXY_CACHE",
     "cache_write",
     "url_encode",
     "sparql_query",
+    "iter_sparql_query",
+    "iter_sparql_rows",
+    "get_sparql_session",
+    "proxy_response",
+    "admit_sparql_query",
+    "limit_sparql_query",
+    "build_concept_hierarchy",
     "draw_concept_hierarchy",
     "get_graph",
+    "is_iri",
+    "mark_response_partial",
     "url_decode"
 ]
 
 
-def cache_write(cache_object):
+# the search index built along with the vocab index in CACHE_FILE
+SEARCH_INDEX_FILE = getattr(config, "SEARCH_INDEX_FILE", os.path.splitext(config.CACHE_FILE)[0] + ".search.p")
+
+# pooled HTTP sessions for SPARQL endpoints, see get_sparql_session()
+_SPARQL_SESSIONS = {}
+_SPARQL_SESSIONS_LOCK = threading.Lock()
+
+# held while loading SEARCH_INDEX_FILE, so that one thread per process reads it, and the (vocab index generation,
+# file mtime) of the last file found to have no search index for the current registry. See get_search_index()
+_SEARCH_INDEX_LOCK = threading.Lock()
+_SEARCH_INDEX_UNAVAILABLE = None
+
+# full RDF graphs of individual vocabs, kept apart from the vocab index in CACHE_FILE
+GRAPH_CACHE = DiskCache(
+    getattr(config, "GRAPH_CACHE_DIR", os.path.join(os.path.dirname(config.CACHE_FILE), "graphs")),
+    max_items=getattr(config, "GRAPH_CACHE_MAX_ITEMS", 20),
+    max_bytes=getattr(config, "GRAPH_CACHE_MAX_BYTES", 500 * 1024 * 1024),
+)
+
+# rendered responses, as (body, status, headers) tuples, keyed by response_cache_key()
+RESPONSE_CACHE = LRUCache(
+    max_items=getattr(config, "RESPONSE_CACHE_MAX_ITEMS", 1000),
+    max_bytes=getattr(config, "RESPONSE_CACHE_MAX_BYTES", 64 * 1024 * 1024),
+    spill=DiskCache(
+        config.RESPONSE_CACHE_DIR,
+        max_bytes=getattr(config, "RESPONSE_CACHE_DIR_MAX_BYTES", 1024 * 1024 * 1024),
+    ) if getattr(config, "RESPONSE_CACHE_DIR", None) else None,
+    sizeof=lambda response: len(response[0]),
+)
+
+# results of queries through /endpoint, as (body, status, Content-Type, Content-Encoding) tuples, keyed by
+# sparql_proxy_cache_key(). Only kept if SPARQL_PROXY_CACHE is set
+SPARQL_PROXY_CACHE = LRUCache(
+    max_items=getattr(config, "SPARQL_PROXY_CACHE_MAX_ITEMS", 1000),
+    max_bytes=getattr(config, "SPARQL_PROXY_CACHE_MAX_BYTES", 64 * 1024 * 1024),
+    ttl=getattr(config, "SPARQL_PROXY_CACHE_TTL", 300),
+    sizeof=lambda result: len(result[0]),
+) if getattr(config, "SPARQL_PROXY_CACHE", False) else None
+
+# admission control for queries through /endpoint, over all processes: at most SPARQL_PROXY_CONCURRENCY queries run at
+# once, at most SPARQL_PROXY_CLIENT_CONCURRENCY of them from any one client, and at most SPARQL_PROXY_QUEUE_SIZE more
+# wait for a turn. See admit_sparql_query()
+_SPARQL_PROXY_SLOTS_DIR = getattr(
+    config, "SPARQL_PROXY_SLOTS_DIR", os.path.join(os.path.dirname(config.CACHE_FILE), "slots"))
+_SPARQL_PROXY_SLOTS = SlotLimiter(
+    os.path.join(_SPARQL_PROXY_SLOTS_DIR, "running"), getattr(config, "SPARQL_PROXY_CONCURRENCY", None))
+_SPARQL_PROXY_CLIENT_SLOTS = SlotLimiter(
+    os.path.join(_SPARQL_PROXY_SLOTS_DIR, "clients"), getattr(config, "SPARQL_PROXY_CLIENT_CONCURRENCY", None))
+_SPARQL_PROXY_QUEUE = SlotLimiter(
+    os.path.join(_SPARQL_PROXY_SLOTS_DIR, "queue"), getattr(config, "SPARQL_PROXY_QUEUE_SIZE", None))
+
+# string literals and IRIs, within which sparql_proxy_cache_key() must not normalise whitespace nor limit_sparql_query()
+# look for comments, and runs of whitespace and comments
+# the characters allowed in a SPARQL IRIREF. See is_iri()
+_IRIREF = re.compile(r'[^\x00-\x20<>"{}|^`\\]+')
+
+_SPARQL_TOKENS = re.compile("|".join((
+    r'("""(?:[^"\\]|\\.|"(?!""))*"""' r"|'''(?:[^'\\]|\\.|'(?!''))*'''"
+    r'|"(?:[^"\\\n]|\\.)*"' r"|'(?:[^'\\\n]|\\.)*'" r'|<[^<>"{}|^`\\\s]*>)',
+    r"((?:\s|#[^\n]*)+)",
+)))
+
+
+def cache_write(vocabs, generation=None, search_index=None, types=None):
     """
-    Function to write object to cache if cache file is older than cache_hours.
+    Function to write the vocab index to the cache file, shared by all processes, in the format of vocprez.index, which
+    processes map into memory rather than each deserialising a copy. The search index, which is only needed once /search
+    is first used, is pickled to a file of its own (SEARCH_INDEX_FILE).
+
+    The files are written under temporary names and then moved into place so that other processes never read a
+    partially written file.
     """
-    logging.debug("cache_write({})".format(cache_object))
+    logging.debug("cache_write()")
 
     # create dir if not there
     if not os.path.isdir(os.path.dirname(config.CACHE_FILE)):
         os.makedirs(os.path.dirname(config.CACHE_FILE))
 
-    with open(config.CACHE_FILE, "wb") as cache_file:
-        pickle.dump(cache_object, cache_file)
+    generation = generation or uuid.uuid4().hex
+
+    # the search index is written first so that it's ready by the time a process loads the vocab index
+    if search_index is not None:
+        tmp_file = "{}.{}.tmp".format(SEARCH_INDEX_FILE, os.getpid())
+        with open(tmp_file, "wb") as search_index_file:
+            pickle.dump({"generation": generation, "search_index": search_index}, search_index_file)
+        os.replace(tmp_file, SEARCH_INDEX_FILE)
+
+    tmp_file = "{}.{}.tmp".format(config.CACHE_FILE, os.getpid())
+    with open(tmp_file, "wb") as cache_file:
+        write_index(cache_file, vocabs, generation, types)
+    os.replace(tmp_file, config.CACHE_FILE)
+
+    return generation
 
 
 def cache_clear():
     logging.debug("cache_clear()")
 
-    # clear the Flask cache
-    if hasattr(g, "VOCABS"):
+    # clear the process-level registry and the Flask cache
+    REGISTRY.clear()
+    if has_app_context() and hasattr(g, "VOCABS"):
         g.VOCABS = None
 
-    # remove the pickle cache
-    if os.path.isfile(config.CACHE_FILE):
-        os.unlink(config.CACHE_FILE)
+    # remove the cache files
+    for cache_file in (config.CACHE_FILE, SEARCH_INDEX_FILE):
+        if os.path.isfile(cache_file):
+            os.unlink(cache_file)
+
+    GRAPH_CACHE.clear()
+    RESPONSE_CACHE.clear()
+    if SPARQL_PROXY_CACHE is not None:
+        SPARQL_PROXY_CACHE.clear()
+
+
+def response_cache_key(request):
+    """
+    The RESPONSE_CACHE key for a request: its path, all of its query string and form arguments, whichever order they are
+    given in, and the headers that content negotiation looks at, tagged with the generation of the vocab index the
+    response is rendered from so that responses rendered from an older index are never served once a newer one is loaded
+    """
+    return "|".join((
+        REGISTRY.generation or "",
+        request.path,
+        urllib.parse.urlencode(sorted(request.values.items(multi=True))),
+        request.headers.get("Accept", ""),
+        request.headers.get("Accept-Profile", ""),
+        request.headers.get("Accept-Language", ""),
+    ))
+
+
+def mark_response_partial():
+    """
+    Marks the response to the current request as incomplete, e.g. because one of the queries for its parts failed, so
+    that it is not kept in RESPONSE_CACHE nor given validators that would let clients keep it
+    """
+    if has_app_context():
+        g.partial_response = True
+
+
+def response_is_partial():
+    return has_app_context() and g.get("partial_response", False)
+
+
+def response_etag(request):
+    """
+    A strong ETag for the response to a request, made from everything its response_cache_key() is, so that it differs
+    for any two requests whose responses may differ and changes whenever the vocab index is reloaded
+    """
+    return hashlib.sha1(response_cache_key(request).encode("utf-8")).hexdigest()
+
+
+def get_last_modified(uri=None, vocab_id=None):
+    """
+    The last modification time of an object: the dcterms:modified date of the vocab it is, or is in. For the lists of
+    all vocabs (no uri or vocab_id given) it is the time the vocab index was built, since vocabs being added or removed
+    changes the lists without changing any vocab's modified date
+
+    :param uri: URI of a ConceptScheme, Collection or Concept
+    :param vocab_id: ID of a vocab, if not given by uri
+    :return: a timezone-aware datetime, or None if it is not known
+    """
+    if uri is None and vocab_id is None:
+        built = REGISTRY.source_mtime or REGISTRY.loaded_at
+        return datetime.datetime.fromtimestamp(built, datetime.timezone.utc) if built is not None else None
+
+    vocabs = REGISTRY.vocabs or {}
+    if uri is not None:
+        if uri not in vocabs:
+            object_type = get_object_type(uri)
+            if object_type is None:
+                return None
+            uri = object_type[1]
+        vocab = vocabs.get(uri)
+        modified = [vocab.modified] if vocab is not None else []
+    else:
+        modified = [v.modified for v in vocabs.values() if v.id == vocab_id]
+
+    modified = [_as_utc(m) for m in modified if m is not None]
+    return max(modified) if modified else None
+
+
+def _as_utc(d):
+    if not isinstance(d, datetime.datetime):
+        d = datetime.datetime(d.year, d.month, d.day)
+    if d.tzinfo is None:
+        return d.replace(tzinfo=datetime.timezone.utc)
+    return d.astimezone(datetime.timezone.utc)
+
+
+def sparql_proxy_cache_key(query, mimetype, accept_encoding):
+    """
+    The SPARQL_PROXY_CACHE key for a query through /endpoint: the query with comments removed and runs of whitespace
+    outside of string literals and IRIs collapsed, so that trivially different layouts of one query share a result,
+    and the media type and encodings asked of the endpoint, tagged with the generation of the vocab index so that every
+    process stops serving results from before a reload once it loads the new index
+    """
+    def normalise(match):
+        literal, whitespace = match.groups()
+        return literal if literal is not None else " "
+
+    return "|".join((
+        REGISTRY.generation or "",
+        _SPARQL_TOKENS.sub(normalise, query).strip(),
+        mimetype,
+        accept_encoding,
+    ))
+
+
+def admit_sparql_query(client):
+    """
+    Waits for a turn to run a query through /endpoint, for up to SPARQL_PROXY_QUEUE_SECONDS. No waiting is done if
+    SPARQL_PROXY_QUEUE_SIZE others are already waiting, so that proxy traffic can't tie up all the worker processes that
+    the HTML routes also need
+
+    :param client: identifies the client, whose queries are limited to SPARQL_PROXY_CLIENT_CONCURRENCY at a time
+    :return: a function to call once the query's response is finished, or None if there was no turn free in time
+    """
+    def admit(wait):
+        deadline = time.time() + wait
+        release_client = _SPARQL_PROXY_CLIENT_SLOTS.acquire(client, wait=wait)
+        if release_client is None:
+            return None
+        release_running = _SPARQL_PROXY_SLOTS.acquire(wait=max(deadline - time.time(), 0))
+        if release_running is None:
+            release_client()
+            return None
+
+        def release():
+            release_running()
+            release_client()
+        return release
+
+    # only queries that can't run straight away take a place in the queue
+    release = admit(0)
+    if release is not None:
+        return release
+
+    release_queued = _SPARQL_PROXY_QUEUE.acquire()
+    if release_queued is None:
+        return None
+    try:
+        return admit(getattr(config, "SPARQL_PROXY_QUEUE_SECONDS", 5))
+    finally:
+        release_queued()
+
+
+def limit_sparql_query(query, limit):
+    """
+    Caps the number of results a SELECT, CONSTRUCT or DESCRIBE query asks for at limit, by adding a LIMIT to the end of a
+    query without one, or lowering a larger one. Queries ending in anything but a group graph pattern or solution
+    modifiers, such as a VALUES block, are left as they are
+    """
+    if limit is None or re.search(r"\b(SELECT|CONSTRUCT|DESCRIBE)\b", query, re.IGNORECASE) is None:
+        return query
+
+    # the end of the query, ignoring trailing whitespace and comments, which are found with _SPARQL_TOKENS so that a "#"
+    # in an IRI or string literal isn't taken for the start of a comment
+    end = len(query)
+    for token in _SPARQL_TOKENS.finditer(query):
+        if token.group(2) is not None and token.end() == len(query):
+            end = token.start()
+    body = query[:end]
+    modifiers = re.search(
+        r"\bLIMIT\s+(\d+)(?:\s+OFFSET\s+\d+)?$|\bOFFSET\s+\d+\s+LIMIT\s+(\d+)$", body, re.IGNORECASE)
+    if modifiers is not None:
+        group = 1 if modifiers.group(1) is not None else 2
+        if int(modifiers.group(group)) <= limit:
+            return query
+        return body[:modifiers.start(group)] + str(limit) + body[modifiers.end(group):] + query[end:]
+    if re.search(r"\bVALUES\b[^{}]*{[^{}]*}$", body, re.IGNORECASE):
+        return query
+
+    # only solution modifiers may follow the query's last brace
+    tail = body[body.rfind("}") + 1:]
+    if "}" in body and (tail == "" or re.match(r"\s*(GROUP\s+BY|HAVING|ORDER\s+BY|OFFSET)\b", tail, re.IGNORECASE)):
+        return body + "\nLIMIT {}".format(limit) + query[end:]
+    return query
+
+
+def _collect_from_sources(collect):
+    """
+    Calls collect(source_details) for all of the sources in config.DATA_SOURCES at once, each on a thread of its own, so
+    that collecting takes as long as the slowest source rather than all of them one after another. Each source is given
+    the "collect_timeout" in its details, or else COLLECT_TIMEOUT, seconds from the start
+
+    :return: a (dict of results, dict of exceptions) tuple, each keyed by source name: the results of the sources that
+    returned in time and the exceptions of those that failed or timed out, which are logged
+    """
+    pool = ThreadPoolExecutor(max_workers=max(len(config.DATA_SOURCES), 1), thread_name_prefix="vocprez-collect")
+    futures = {name: pool.submit(collect, details) for name, details in config.DATA_SOURCES.items()}
+    # a source that times out is left to finish on its own, and its result ignored
+    pool.shutdown(wait=False)
+
+    started = time.time()
+    results = {}
+    failures = {}
+    for name, future in futures.items():
+        timeout = config.DATA_SOURCES[name].get("collect_timeout", getattr(config, "COLLECT_TIMEOUT", 300))
+        try:
+            results[name] = future.result(timeout=max(started + timeout - time.time(), 0))
+        except TimeoutError as e:
+            logging.error("Timed out collecting from source {} after {} seconds".format(name, timeout))
+            failures[name] = e
+        except Exception as e:
+            logging.error("Unable to collect from source {}: {}".format(name, e))
+            failures[name] = e
+    return results, failures
+
+
+def collect_vocabs():
+    """
+    Builds a new vocab index by calling collect() for each of the sources in config.DATA_SOURCES, concurrently.
+
+    The vocabs of a SPARQL source that fails or times out are kept from the current registry, if it has them, so that an
+    unavailable source only misses this refresh rather than having its vocabs removed. Only if every source fails is
+    the error raised
+    """
+    results, failures = _collect_from_sources(lambda details: getattr(source, details["source"]).collect(details))
+    if failures and not results:
+        raise next(iter(failures.values()))
+
+    vocabs = {}
+    for name, source_details in config.DATA_SOURCES.items():
+        if name in results:
+            vocabs.update(results[name])
+        else:
+            kept = {uri: REGISTRY.vocabs[uri] for uri in _previous_vocabs(source_details)}
+            logging.warning("Keeping the {} vocabs of source {} from the previous build".format(len(kept), name))
+            vocabs.update(kept)
+    return vocabs
+
+
+def _previous_vocabs(source_details, vocab_uris=None):
+    """
+    The URIs of the vocabs in the current registry that came from a SPARQL source, going by their SPARQL endpoints, for
+    keeping what was collected from it before when it fails
+
+    :param vocab_uris: if given, only those of these vocabs
+    :rtype: set
+    """
+    if not REGISTRY.is_loaded() or source_details.get("sparql_endpoint") is None:
+        return set()
+    return {
+        uri for uri, vocab in REGISTRY.vocabs.items()
+        if vocab.sparql_endpoint == source_details["sparql_endpoint"] and (vocab_uris is None or uri in vocab_uris)
+    }
+
+
+def collect_types(vocab_uris=None):
+    """
+    Builds a new map of the URIs of all ConceptSchemes, Collections and Concepts to (class URI, ConceptScheme URI)
+    tuples, from each of the sources in config.DATA_SOURCES.
+
+    The objects of the vocabs of a source that fails or times out are kept from the current registry's map, if it has
+    one, as collect_vocabs() keeps their vocabs. Only if every source fails is the error raised
+
+    :param vocab_uris: if given, only the objects of these vocabs are collected
+    """
+    started = time.time()
+    types = {}
+    if vocab_uris is not None and len(vocab_uris) == 0:
+        return types
+
+    def collect(source_details):
+        source_types = {}
+        getattr(source, source_details["source"]).collect_types(source_details, source_types, vocab_uris)
+        return source_types
+
+    results, failures = _collect_from_sources(collect)
+    if failures and not results:
+        raise next(iter(failures.values()))
+    # merged in the order of the sources, so that the first source to have an object gives its class
+    for name, source_details in config.DATA_SOURCES.items():
+        if name in results:
+            source_types = results[name]
+        else:
+            kept_vocabs = _previous_vocabs(source_details, vocab_uris)
+            source_types = {
+                uri: object_type for uri, object_type in (REGISTRY.types.items() if REGISTRY.types is not None else ())
+                if object_type[1] in kept_vocabs
+            }
+            logging.warning("Keeping the classes of {} objects of source {} from the previous build".format(
+                len(source_types), name))
+        for uri, object_type in source_types.items():
+            types.setdefault(uri, object_type)
+    logging.info("Collected the classes of {} objects in {:.2f} seconds".format(len(types), time.time() - started))
+    return types
+
+
+def get_object_type(uri):
+    """
+    Looks up the class and ConceptScheme of an object in the current registry's type map
+
+    :return: a (class URI, ConceptScheme URI) tuple, or None if the object is not known
+    """
+    if REGISTRY.types is None:
+        return None
+    return REGISTRY.types.get(uri)
+
+
+def is_iri(uri):
+    """
+    Whether a string can be written as a SPARQL IRIREF, <uri>, i.e. has none of the characters IRIREFs can't: whitespace
+    and other control characters, <>"{}|^` and backslash. Strings given by users must be checked before being put in a
+    query
+    """
+    return bool(uri) and _IRIREF.fullmatch(uri) is not None
+
+
+def get_object_types(uris):
+    """
+    Looks up the classes and ConceptSchemes of several objects: in the current registry's type map, and for those it
+    doesn't know (e.g. if it couldn't be built, or the objects were added since), from the SPARQL endpoint with one
+    query per GET_CONCEPTS_BATCH_SIZE objects, whose URIs are given in a VALUES block
+
+    :return: a dict of object URIs to lists of (class URI, ConceptScheme URI) tuples, with no entry for objects not found
+    or URIs that aren't IRIs (see is_iri())
+    """
+    types = {}
+    unknown = []
+    for uri in uris:
+        object_type = get_object_type(uri)
+        if object_type is not None:
+            types[uri] = [object_type]
+        elif is_iri(uri):
+            unknown.append(uri)
+
+    batch_size = getattr(config, "GET_CONCEPTS_BATCH_SIZE", 100)
+    for batch in range(0, len(unknown), batch_size):
+        q = """
+            PREFIX skos: <http://www.w3.org/2004/02/skos/core#>
+
+            SELECT DISTINCT ?o ?c ?cs
+            WHERE {{
+                VALUES ?o {{ {uris} }}
+                GRAPH ?g {{
+                    ?o a ?c .
+                    OPTIONAL {{
+                        VALUES ?memberof {{ skos:inScheme skos:topConceptOf }}
+                        ?o ?memberof ?cs .
+                    }}
+                }}
+            }}
+            """.format(uris=" ".join("<{}>".format(uri) for uri in unknown[batch:batch + batch_size]))
+        for r in sparql_query(q) or []:
+            types.setdefault(r["o"]["value"], []).append((r["c"]["value"], r["cs"]["value"] if r.get("cs") else None))
+
+    return types
+
+
+def collect_search_index(vocab_uris=None, search_index=None):
+    """
+    Builds a new search index over all Concepts' labels and definitions, from each of the sources in
+    config.DATA_SOURCES. Each source adds to an index of its own, which is merged into the new one if it completes in
+    time.
+
+    The Concepts of the vocabs of a source that fails or times out are kept from the current registry's search index,
+    if there is one, as collect_vocabs() keeps their vocabs. Only if every source fails is the error raised
+
+    :param vocab_uris: if given, only the Concepts of these vocabs are collected
+    :param search_index: a SearchIndex to add the Concepts to, rather than a new one
+    """
+    started = time.time()
+    search_index = search_index if search_index is not None else SearchIndex()
+    if vocab_uris is None or len(vocab_uris) > 0:
+        def collect(source_details):
+            source_index = SearchIndex()
+            getattr(source, source_details["source"]).collect_search_index(source_details, source_index, vocab_uris)
+            return source_index
+
+        results, failures = _collect_from_sources(collect)
+        if failures and not results:
+            raise next(iter(failures.values()))
+        previous = None
+        for name, source_details in config.DATA_SOURCES.items():
+            if name in results:
+                search_index.add_index(results[name])
+                continue
+            if previous is None:
+                previous = REGISTRY.search_index or _load_search_index_file(REGISTRY.generation) or SearchIndex()
+            # the named graph of a vocab's Concepts is taken to have the vocab's URI, as in _collect_changes()
+            kept_vocabs = _previous_vocabs(source_details, vocab_uris)
+            search_index.add_index(previous, kept_vocabs)
+            logging.warning("Keeping the search index entries of {} vocabs of source {} from the previous build".format(
+                len(kept_vocabs), name))
+    search_index.finalise()
+    logging.info("Built search index ({} Concepts) in {:.2f} seconds".format(
+        len(search_index), time.time() - started))
+    return search_index
+
+
+def get_search_index():
+    """
+    The search index of the current registry, loaded from SEARCH_INDEX_FILE the first time it's needed. The index is
+    only built along with the vocab index, by _rebuild(), so if that file is missing or was built along with a different
+    vocab index, this returns None until the next rebuild. Such a file isn't read again until it changes
+
+    :return: a SearchIndex, or None if there is none for the current registry
+    """
+    if REGISTRY.search_index is not None:
+        return REGISTRY.search_index
+
+    global _SEARCH_INDEX_UNAVAILABLE
+    with _SEARCH_INDEX_LOCK:
+        # another thread may have loaded it while this one waited for the lock
+        if REGISTRY.search_index is not None:
+            return REGISTRY.search_index
+
+        generation = REGISTRY.generation
+        try:
+            mtime = os.stat(SEARCH_INDEX_FILE).st_mtime
+        except OSError:
+            return None
+        if _SEARCH_INDEX_UNAVAILABLE == (generation, mtime):
+            return None
+
+        search_index = _load_search_index_file(generation)
+        if search_index is None:
+            logging.warning("No search index for vocab index {} in {}".format(generation, SEARCH_INDEX_FILE))
+            _SEARCH_INDEX_UNAVAILABLE = (generation, mtime)
+        elif REGISTRY.generation == generation:  # unless another vocab index has been swapped in meanwhile
+            REGISTRY.search_index = search_index
+        return search_index
+
+
+def _load_search_index_file(generation):
+    try:
+        with open(SEARCH_INDEX_FILE, "rb") as f:
+            cached = pickle.load(f)
+        if cached["generation"] == generation:
+            return cached["search_index"]
+    except FileNotFoundError:
+        pass
+    except (pickle.UnpicklingError, EOFError, KeyError, TypeError) as e:
+        logging.warning("Ignoring unreadable search index file {}: {}".format(SEARCH_INDEX_FILE, e))
+    return None
+
+
+def _cache_file_mtime():
+    try:
+        return os.stat(config.CACHE_FILE).st_mtime
+    except OSError:
+        return None
+
+
+def _cache_file_is_fresh(mtime):
+    return mtime is not None and time.time() - mtime < config.CACHE_HOURS * 3600
+
+
+@contextmanager
+def _cache_lock():
+    """
+    File lock shared by all processes (e.g. all gunicorn workers) so that only one of them rebuilds the cache at a time
+    """
+    if not os.path.isdir(os.path.dirname(config.CACHE_FILE)):
+        os.makedirs(os.path.dirname(config.CACHE_FILE), exist_ok=True)
+
+    with open(config.CACHE_FILE + ".lock", "a") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _load_cache_file():
+    """
+    Loads the registry from CACHE_FILE
+
+    :return: True if the registry was loaded, False if the file is missing or not a vocab index file
+    """
+    try:
+        mtime = os.stat(config.CACHE_FILE).st_mtime
+        index = MappedIndex(config.CACHE_FILE)
+        REGISTRY.swap(index.vocabs(), index.generation, mtime, types=index.types)
+        return True
+    except FileNotFoundError:
+        return False
+    except IndexFormatError as e:
+        logging.warning("Ignoring unreadable cache file {}: {}".format(config.CACHE_FILE, e))
+        return False
+
+
+def _rebuild(force=False, full=False):
+    """
+    Rebuilds the registry & CACHE_FILE from collect() methods, unless another process has just done so while this one
+    waited for the cache lock, in which case that process' cache file is loaded instead.
+
+    collect() is always called for every source, but if there is a current registry, only the objects and search index
+    entries of the vocabs that are new, removed or modified since it was built are re-fetched. See _collect_changes()
+
+    :param force: rebuild even if the cache file is fresh
+    :param full: re-fetch everything, not only the vocabs that have changed
+    """
+    with _cache_lock():
+        mtime = _cache_file_mtime()
+        if _cache_file_is_fresh(mtime) and not force:
+            if mtime != REGISTRY.source_mtime and _load_cache_file():
+                logging.debug("loaded registry rebuilt by another process")
+                return
+
+            if REGISTRY.is_loaded():
+                return
+
+        # changes are found against the latest build, which may be another process'
+        if mtime is not None and mtime != REGISTRY.source_mtime and not full:
+            _load_cache_file()
+
+        logging.debug("build registry & CACHE_FILE from collect() methods")
+        started = time.time()
+        vocabs = collect_vocabs()
+        if REGISTRY.is_loaded() and not full:
+            types, search_index, changed = _collect_changes(vocabs)
+        else:
+            (types, search_index), changed = _collect_all(), None
+        cache_write(vocabs, search_index=search_index, types=types)
+        # loaded back from the file, like the other processes, so that this one shares its pages too
+        _load_cache_file()
+        REGISTRY.search_index = search_index
+        REGISTRY.last_refresh_seconds = time.time() - started
+        if changed is None:
+            logging.info("Rebuilt vocab cache ({} vocabs) in {:.2f} seconds".format(
+                len(vocabs), REGISTRY.last_refresh_seconds))
+        else:
+            logging.info("Refreshed vocab cache ({} vocabs, {} new, removed or modified) in {:.2f} seconds".format(
+                len(vocabs), len(changed), REGISTRY.last_refresh_seconds))
+
+
+def _collect_all():
+    """The type map and search index of all vocabs, either of which is None if it could not be collected"""
+    try:
+        types = collect_types()
+    except Exception as e:
+        logging.error("Unable to collect object classes: {}".format(e))
+        types = None
+    try:
+        search_index = collect_search_index()
+    except Exception as e:
+        logging.error("Unable to build search index: {}".format(e))
+        search_index = None
+    return types, search_index
+
+
+def _collect_changes(vocabs):
+    """
+    The type map and search index for a new vocab index, made from those of the current registry by dropping the
+    objects of vocabs that have been removed or modified since it was built and collecting those of new and modified
+    vocabs. Vocabs are matched to objects by their ConceptScheme and to search index entries by their named graph,
+    which is taken to have the vocab's URI. Anything that can't be made this way is collected in full
+
+    :param vocabs: the new dict of Vocabulary objects, keyed by vocab URI
+    :return: a (type map, search index, set of the URIs of the new, removed & modified vocabs) tuple
+    """
+    changed = REGISTRY.changed_vocabs(vocabs)
+    stale = changed | (set(REGISTRY.vocabs) - set(vocabs))
+    logging.debug("{} of {} vocabs new or modified, {} removed".format(
+        len(changed), len(vocabs), len(stale) - len(changed)))
+
+    try:
+        if REGISTRY.types is None:
+            types = collect_types()
+        else:
+            types = {
+                uri: (cls, scheme) for uri, (cls, scheme) in REGISTRY.types.items()
+                if uri not in stale and scheme not in stale
+            }
+            types.update(collect_types(changed))
+    except Exception as e:
+        logging.error("Unable to collect object classes: {}".format(e))
+        types = None
+
+    try:
+        previous = REGISTRY.search_index or _load_search_index_file(REGISTRY.generation)
+        if previous is None:
+            search_index = collect_search_index()
+        else:
+            search_index = collect_search_index(changed, previous.without_graphs(stale))
+    except Exception as e:
+        logging.error("Unable to build search index: {}".format(e))
+        search_index = None
+
+    return types, search_index, stale
+
+
+def _refresh_in_background():
+    """
+    Rebuilds the registry in a background thread, at most one per process, while requests keep being served from the
+    current (stale) registry. After a refresh fails, none is tried again for CACHE_REFRESH_RETRY_SECONDS, so that an
+    unavailable source isn't queried afresh on every request
+    """
+    retry_seconds = getattr(config, "CACHE_REFRESH_RETRY_SECONDS", config.CACHE_HOURS * 3600 / 4)
+    with REGISTRY.lock:
+        if REGISTRY.refreshing:
+            return
+        if REGISTRY.refresh_failed_at is not None and time.time() - REGISTRY.refresh_failed_at < retry_seconds:
+            return
+        REGISTRY.refreshing = True
+
+    def refresh():
+        try:
+            _rebuild()
+            REGISTRY.refresh_failed_at = None
+        except Exception as e:
+            logging.error("Background cache refresh failed: {}".format(e))
+            REGISTRY.refresh_failed_at = time.time()
+        finally:
+            REGISTRY.refreshing = False
+
+    logging.debug("starting background cache refresh")
+    threading.Thread(target=refresh, name="vocprez-cache-refresh", daemon=True).start()
 
 
 def cache_load():
+    """
+    Makes sure the process-level vocab registry is loaded and points g.VOCABS at it for this request.
+
+    The registry is loaded from the cache file if there is one, even if it is older than CACHE_HOURS. Only if there is
+    nothing to serve yet does this request wait for a complete rebuild by calling collect() for each of the sources. A
+    stale or missing cache file is otherwise rebuilt in the background, and the new registry is swapped in when ready.
+    """
     logging.debug("cache_load()")
 
     if config.DEBUG:
         logging.debug("DEBUG so purge cache")
         cache_clear()
 
-    if hasattr(g, "VOCABS"):
-        logging.debug("have g, doing nothing")
-        pass
-    elif os.path.isfile(config.CACHE_FILE):
-        logging.debug("rebuild g from CACHE_FILE")
-        g.VOCABS = {}
-        cache_file_age = time.time() - os.stat(config.CACHE_FILE).st_mtime
-        if cache_file_age < config.CACHE_HOURS * 3600:
-            with open(config.CACHE_FILE, "rb") as f:
-                g.VOCABS = pickle.load(f)
-        else:  # old cache file
-            logging.debug("rebuild g & CACHE_FILE from collect() methods")
-            cache_clear()
-
-            for source_details in config.DATA_SOURCES.values():
-                getattr(source, source_details["source"]).collect(source_details)
-            cache_write(g.VOCABS)
-    else:
-        logging.debug("build g & CACHE_FILE from collect() methods")
-        g.VOCABS = {}
-        for source_details in config.DATA_SOURCES.values():
-            getattr(source, source_details["source"]).collect(source_details)
-        cache_write(g.VOCABS)
+    # REGISTRY.lock is never held here: _rebuild() takes the cache file lock, and whichever thread holds that takes
+    # REGISTRY.lock to swap in the registry it built, so waiting for the one while holding the other would deadlock.
+    # Threads that load the same cache file at once just swap in the same registry
+    mtime = _cache_file_mtime()
+    if not REGISTRY.is_loaded() or (mtime is not None and mtime != REGISTRY.source_mtime):
+        logging.debug("load registry from CACHE_FILE")
+        if not _load_cache_file() and not REGISTRY.is_loaded():
+            # nothing to serve yet so this request has to wait for the build, which is skipped if another thread or
+            # process has done it while this one waited for the cache file lock
+            _rebuild()
 
+    if not _cache_file_is_fresh(_cache_file_mtime()):
+        _refresh_in_background()
 
-def cache_reload():
-    """Cache purging function used in multiple places"""
-    logging.debug("cache_reload()")
-
-    cache_clear()
+    if has_app_context():
+        g.VOCABS = REGISTRY.vocabs
 
-    cache_load()
 
+def cache_reload(full=False):
+    """
+    Rebuilds the registry now, re-fetching only the vocabs that are new or modified since it was last built, and drops
+    the rendered responses and query results of the old one. With full, or if DEBUG is set, everything is purged and
+    re-fetched instead
+    """
+    logging.debug("cache_reload()")
 
-def draw_concept_hierarchy(hierarchy):
-        tab = "\t"
-        previous_length = 1
+    if full or config.DEBUG:
+        cache_clear()
+        cache_load()
+        return
 
-        text = ""
-        tracked_items = []
-        for item in hierarchy:
-            mult = None
+    RESPONSE_CACHE.clear()
+    if SPARQL_PROXY_CACHE is not None:
+        SPARQL_PROXY_CACHE.clear()
+    _rebuild(force=True)
 
-            if item[0] > previous_length + 2:  # SPARQL query error on length value
-                for tracked_item in tracked_items:
-                    if tracked_item["name"] == item[3]:
-                        mult = tracked_item["indent"] + 1
+    if has_app_context():
+        g.VOCABS = REGISTRY.vocabs
 
-            if mult is None:
-                found = False
-                for tracked_item in tracked_items:
-                    if tracked_item["name"] == item[3]:
-                        found = True
-                if not found:
-                    mult = 0
 
-            if mult is None:  # else: # everything is normal
-                mult = item[0] - 1
+def build_concept_hierarchy(rows):
+    """
+    Builds a concept hierarchy from (concept, concept_preflabel, broader_concept) rows, where broader_concept is None
+    for top concepts, in time linear in the number of rows (plus sorting each set of siblings by label).
 
-            t = tab * mult + "* [" + item[2] + "](" + get_content_uri(item[1]) + ")\n"
-            text += t
-            previous_length = mult
-            tracked_items.append({"name": item[1], "indent": mult})
+    A concept with more than one broader concept (polyhierarchy) appears, with all its narrower concepts, under each of
+    them. A concept never appears below itself so cycles of skos:broader are cut where they would loop back.
 
-        return markdown.markdown(text)
+    :param rows: iterable of (concept, concept_preflabel, broader_concept) tuples
+    :return: list of tuples (<level>, <concept>, <concept_preflabel>, <broader_concept>) in depth-first order, starting
+    with level 1 for top concepts and with siblings ordered by label
+    :rtype: list
+    """
+    # one pass to index narrower concepts by their broader concept
+    narrowers = {}
+    for row in rows:
+        narrowers.setdefault(row[2], []).append(row)
+    for siblings in narrowers.values():
+        siblings.sort(key=lambda row: row[1])
+
+    hierarchy = []
+    ancestors = set()
+    # iterative depth-first walk: each stack entry is (iterator over a concept's narrowers, that concept)
+    stack = [(iter(narrowers.get(None, [])), None)]
+    while stack:
+        siblings, broader = stack[-1]
+        row = next(siblings, None)
+        if row is None:
+            stack.pop()
+            ancestors.discard(broader)
+            continue
+
+        concept = row[0]
+        if concept in ancestors:
+            logging.debug("skos:broader cycle at {}".format(concept))
+            continue
+
+        hierarchy.append((len(stack), concept, row[1], row[2]))
+        if concept in narrowers:
+            ancestors.add(concept)
+            stack.append((iter(narrowers[concept]), concept))
+
+    return hierarchy
 
 
-def render_concept_tree(html_doc):
-    soup = BeautifulSoup(html_doc, "html.parser")
+def draw_concept_hierarchy(hierarchy):
+    """
+    Renders a concept hierarchy, as made by build_concept_hierarchy(), directly as nested HTML lists. Concepts with
+    narrower concepts get a caret that expands their list of narrower concepts, which starts collapsed (class "nested").
 
-    # concept_hierarchy = soup.find(id='concept-hierarchy')
+    :param hierarchy: list of tuples (<level>, <concept>, <concept_preflabel>, <broader_concept>) in depth-first order
+    :return: HTML
+    :rtype: str
+    """
+    # work out each item's indent, correcting levels that jump by more than one (SPARQL query error on length value)
+    indents = []
+    tracked_indents = {}
+    previous_indent = 1
+    for item in hierarchy:
+        if item[3] not in tracked_indents:
+            indent = 0
+        elif item[0] > previous_indent + 2:
+            indent = tracked_indents[item[3]] + 1
+        else:  # everything is normal
+            indent = item[0] - 1
+        previous_indent = indent
+        tracked_indents[item[1]] = indent
+        indents.append(indent)
+
+    html = []
+    depth = -1  # indent of the innermost open list
+    for i, item in enumerate(hierarchy):
+        indent = min(indents[i], depth + 1)
+        if indent > depth:
+            # first item of a list, nested in the previous item
+            html.append("<ul>\n" if indent == 0 else '<ul class="nested">\n')
+            depth = indent
+        else:
+            while depth > indent:
+                html.append("</li>\n</ul>\n")
+                depth -= 1
+            html.append("</li>\n")
+
+        link = '<a href="{}">{}</a>'.format(escape(get_content_uri(item[1])), escape(item[2]))
+        if i + 1 < len(hierarchy) and indents[i + 1] > indent:
+            html.append('<li><span class="caret">{}</span>'.format(link))
+        else:
+            html.append("<li>{}".format(link))
 
-    uls = soup.find_all("ul")
+    while depth >= 0:
+        html.append("</li>\n</ul>\n")
+        depth -= 1
 
-    for i, ul in enumerate(uls):
-        # Don't add HTML class nested to the first 'ul' found.
-        if not i == 0:
-            ul["class"] = "nested"
-            if ul.parent.name == "li":
-                temp = BeautifulSoup(str(ul.parent.a.extract()), "html.parser")
-                ul.parent.insert(
-                    0, BeautifulSoup('<span class="caret">', "html.parser")
-                )
-                ul.parent.span.insert(0, temp)
-    return soup
+    return "".join(html)
 
 
 def get_graph(endpoint, q, sparql_username=None, sparql_password=None):
@@ -162,52 +934,193 @@ def get_graph(endpoint, q, sparql_username=None, sparql_password=None):
     return result_graph
 
 
-def sparql_query(
+def get_sparql_session(endpoint, sparql_username=None, sparql_password=None):
+    """
+    Returns the shared, connection-pooled HTTP session for a SPARQL endpoint so that queries reuse keep-alive
+    connections rather than making a new TCP (and TLS) connection each time. There is one session per endpoint and set
+    of credentials, configured with that endpoint's HTTP Basic auth.
+    """
+    key = (endpoint, sparql_username, sparql_password)
+    session = _SPARQL_SESSIONS.get(key)
+    if session is None:
+        with _SPARQL_SESSIONS_LOCK:
+            session = _SPARQL_SESSIONS.get(key)
+            if session is None:
+                session = requests.Session()
+                pool_size = getattr(config, "SPARQL_POOL_SIZE", 10)
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                if not getattr(config, "SPARQL_KEEP_ALIVE", True):
+                    session.headers["Connection"] = "close"
+                if sparql_username and sparql_password:
+                    session.auth = (sparql_username, sparql_password)
+                _SPARQL_SESSIONS[key] = session
+    return session
+
+
+def proxy_response(upstream, mimetype, max_bytes=None, timeout=None, gzip=False, headers=None, cache_key=None):
+    """
+    Makes a Flask Response that streams a SPARQL endpoint's response through to the client as it arrives, rather than
+    holding all of it in memory first. The upstream status, Content-Type and Content-Encoding are passed through.
+
+    :param upstream: a requests Response, requested with stream=True
+    :param mimetype: the Content-Type to use if the endpoint didn't send one
+    :param max_bytes: the response is cut off after this many bytes, by aborting it with an IOError
+    :param timeout: the response is cut off after this many seconds, by aborting it with an IOError
+    :param gzip: whether to gzip the response on the fly if the endpoint didn't encode it. Responses with a
+    Content-Encoding are left alone by Compress, which would otherwise read the whole stream into memory to compress it
+    :param headers: any other headers to send
+    :param cache_key: if given, and SPARQL_PROXY_CACHE is set, a complete, successful response is put in the cache
+    under this key
+    :rtype: :class:`flask.Response`
+    """
+    content_length = upstream.headers.get("Content-Length")
+    if max_bytes is not None and content_length is not None and int(content_length) > max_bytes:
+        upstream.close()
+        return Response(
+            "The SPARQL endpoint's response, of {} bytes, is larger than the {} bytes allowed".format(
+                content_length, max_bytes),
+            status=502,
+            mimetype="text/plain",
+        )
+
+    headers = dict(headers or {})
+    headers["Vary"] = "Accept-Encoding"
+    content_encoding = upstream.headers.get("Content-Encoding")
+    gzip = gzip and content_encoding is None
+    if content_encoding is not None:
+        headers["Content-Encoding"] = content_encoding
+    elif gzip:
+        headers["Content-Encoding"] = "gzip"
+
+    deadline = time.time() + timeout if timeout is not None else None
+
+    cache = SPARQL_PROXY_CACHE if cache_key is not None and upstream.status_code == 200 else None
+
+    def stream():
+        compressor = zlib.compressobj(wbits=31) if gzip else None  # wbits=31: gzip container
+        received = 0
+        # the upstream bytes are kept to be cached only while they would still fit in the cache
+        kept = [] if cache is not None else None
+        try:
+            for chunk in upstream.raw.stream(64 * 1024, decode_content=False):
+                received += len(chunk)
+                cut_off = None
+                if max_bytes is not None and received > max_bytes:
+                    cut_off = "SPARQL proxy response cut off at {} bytes".format(max_bytes)
+                elif deadline is not None and time.time() > deadline:
+                    cut_off = "SPARQL proxy response cut off after {} seconds".format(timeout)
+                if cut_off is not None:
+                    logging.warning(cut_off)
+                    # what has been compressed so far is sent, but not the end of the gzip stream, and the response is
+                    # aborted rather than ended as if it were complete, so that the client can tell it was cut off
+                    if compressor is not None:
+                        yield compressor.flush(zlib.Z_SYNC_FLUSH)
+                    raise IOError(cut_off)
+                if kept is not None:
+                    if cache.max_bytes is not None and received > cache.max_bytes:
+                        kept = None
+                    else:
+                        kept.append(chunk)
+                if compressor is not None:
+                    chunk = compressor.compress(chunk)
+                if chunk:
+                    yield chunk
+            if compressor is not None:
+                yield compressor.flush()
+            if kept is not None:
+                cache.put(cache_key, (b"".join(kept), upstream.status_code, content_type, content_encoding))
+        finally:
+            upstream.close()
+
+    content_type = upstream.headers.get("Content-Type", mimetype)
+    return Response(stream(), status=upstream.status_code, content_type=content_type, headers=headers)
+
+
+def _stream_sparql_query(q, accept, parse, sparql_endpoint, sparql_username, sparql_password):
+    """Runs a query, passing its response to parse(chunks, Content-Type) as it arrives and yielding what that yields"""
+    session = get_sparql_session(sparql_endpoint, sparql_username, sparql_password)
+    headers = {
+        "Accept": accept,
+        "Content-Type": "application/sparql-query",
+    }
+
+    with session.post(
+        sparql_endpoint,
+        data=q.encode("utf-8"),
+        headers=headers,
+        timeout=config.SPARQL_TIMEOUT,
+        stream=True,
+    ) as response:
+        response.raise_for_status()
+        yield from parse(response.iter_content(64 * 1024), response.headers.get("Content-Type", ""))
+
+
+def iter_sparql_query(
         q,
         sparql_endpoint=config.SPARQL_ENDPOINT,
         sparql_username=config.SPARQL_USERNAME,
         sparql_password=config.SPARQL_PASSWORD):
-    sparql = SPARQLWrapper(sparql_endpoint)
-    sparql.setQuery(q)
-    sparql.setReturnFormat(JSON)
+    """
+    Runs a SELECT query, yielding each result's bindings as it is parsed from the response, so that large results are
+    never held in memory as a whole. Errors are raised, part way through the results if need be
+
+    :return: an iterator of dicts of bindings, keyed by variable name, in the form of the SPARQL JSON results format
+    """
+    return _stream_sparql_query(
+        q,
+        "application/sparql-results+json, application/sparql-results+xml;q=0.9",
+        iter_bindings,
+        sparql_endpoint,
+        sparql_username,
+        sparql_password,
+    )
+
+
+def iter_sparql_rows(
+        q,
+        variables,
+        sparql_endpoint=config.SPARQL_ENDPOINT,
+        sparql_username=config.SPARQL_USERNAME,
+        sparql_password=config.SPARQL_PASSWORD):
+    """
+    Runs a SELECT query, yielding each result as a tuple of the values of variables, with None for those unbound, for
+    loops that only need values, not their types or languages. The results are asked for as TSV, which is decoded
+    straight to tuples without making the dicts of the JSON results format, but JSON or XML is used if that is all the
+    endpoint gives. Errors are raised, part way through the results if need be
+
+    :param variables: a sequence of variable names, without "?"
+    :return: an iterator of tuples of str or None
+    """
+    return _stream_sparql_query(
+        q,
+        "text/tab-separated-values, application/sparql-results+json;q=0.9, application/sparql-results+xml;q=0.8",
+        lambda chunks, content_type: iter_rows(chunks, content_type, variables),
+        sparql_endpoint,
+        sparql_username,
+        sparql_password,
+    )
 
-    if sparql_username and sparql_password:
-        sparql.setHTTPAuth(BASIC)
-        sparql.setCredentials(sparql_username, sparql_password)
 
+def sparql_query(
+        q,
+        sparql_endpoint=config.SPARQL_ENDPOINT,
+        sparql_username=config.SPARQL_USERNAME,
+        sparql_password=config.SPARQL_PASSWORD):
+    """
+    Runs a SELECT query
+
+    :return: a list of dicts of bindings, keyed by variable name, in the form of the SPARQL JSON results format, or None
+    if the query failed
+    """
     try:
-        r = sparql.queryAndConvert()
-
-        if isinstance(r, xml_Document):
-            def getText(node):
-                nodelist = node.childNodes
-                result = []
-                for node in nodelist:
-                    if node.nodeType == node.TEXT_NODE:
-                        result.append(node.data)
-                return ''.join(result)
-
-            results = []
-            for result in r.getElementsByTagName('result'):
-                bindings = {}
-                for binding in result.getElementsByTagName('binding'):
-                    for val in binding.childNodes:
-                        bindings[binding.getAttribute("name")] = {
-                            "type": "uri" if val.tagName == "uri" else "literal",
-                            "value": getText(val)
-                        }
-                results.append(bindings)
-            return results
-        elif isinstance(r, dict):
-            # JSON
-            return r["results"]["bindings"]
-        else:
-            raise Exception("Could not convert results from SPARQL endpoint")
+        return list(iter_sparql_query(q, sparql_endpoint, sparql_username, sparql_password))
     except Exception as e:
         logging.debug("SPARQL query failed: {}".format(e))
         logging.debug(
-            "endpoint={}\nsparql_username={}\nsparql_password={}\n{}".format(
-               q,  sparql_endpoint, sparql_username, sparql_password
+            "endpoint={}\nsparql_username={}\n{}".format(
+               sparql_endpoint, sparql_username, q
             )
         )
         return None
@@ -227,24 +1140,16 @@ def submit_sparql_query(
     headers = {
         "Accept": accept_format,
         "Content-Type": "application/sparql-query",
-        "Accept-Encoding": "UTF-8",
     }
-    if sparql_username and sparql_password:
-        # logging.debug('Authenticating with username {} and password {}'.format(sparql_username, sparql_password))
-        headers["Authorization"] = "Basic " + base64.encodebytes(
-            "{}:{}".format(sparql_username, sparql_password).encode("utf-8")
-        ).strip().decode("utf-8")
-
-    params = None
+    session = get_sparql_session(endpoint, sparql_username, sparql_password)
 
     retries = 0
     while True:
         try:
-            response = requests.post(
+            response = session.post(
                 endpoint,
                 headers=headers,
-                params=params,
-                data=q,
+                data=q.encode("utf-8"),
                 timeout=config.SPARQL_TIMEOUT,
             )
             # logging.debug('Response content: {}'.format(str(response.content)))